@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+'''
+Measure the throughput of the ImageNet input pipeline, without a GPU.
+
+Builds a synthetic ImageNet tree of 256x256 images (tmp/n<synid>/*.jpg plus
+batches.meta and image-mean.pickle) unless --data_dir is given, then loads
+batches through every provider configuration with the provider's own reader
+threads and prints a JSON report: images/sec and the time spent in every stage (decode, crop,
+mean, labels, and wait, the time the consumer blocked on the readers).  With
+--cold the images are dropped from the page cache before every configuration,
+so decode includes reading them from disk.
+'''
+
+from PIL import Image
+from os.path import join
+from striate import data, readahead, util
+import argparse
+import cPickle
+import json
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def build_tree(data_dir, num_categories, images_per_category, seed):
+  rng = np.random.RandomState(seed)
+  synid_to_label = {}
+  for c in range(num_categories):
+    synid = '%08d' % c
+    synid_to_label[synid] = c
+    os.makedirs(join(data_dir, 'n' + synid))
+    for i in range(images_per_category):
+      pixels = rng.randint(0, 256, size = (256, 256, 3)).astype(np.uint8)
+      Image.fromarray(pixels).save(join(data_dir, 'n' + synid, 'n%s_%d.jpg' % (synid, i)), quality = 90)
+
+  with open(join(data_dir, 'batches.meta'), 'wb') as f:
+    cPickle.dump({'synid_to_label': synid_to_label}, f, protocol = -1)
+  with open(join(data_dir, 'image-mean.pickle'), 'wb') as f:
+    cPickle.dump({'data': np.zeros(3 * 256 * 256, dtype = np.float32)}, f, protocol = -1)
+
+
+def run(data_dir, batch_range, batch_size, num_batches, rounds, config, cold = False):
+  dp = data.ImageNetDataProvider(data_dir, batch_range, batch_size = batch_size, **config)
+  if cold:
+    readahead.evict(dp.sources)
+  try:
+    for r in range(rounds):
+      # only the last round is measured, so caches are warm
+      dp.timings.reset()
+      num_imgs = 0
+      start = time.time()
+      for batch, labels, _ in dp.iter_batches(num_batches):
+        num_imgs += len(labels)
+        dp.buffers.put(batch)
+      elapsed = time.time() - start
+  finally:
+    dp.close()
+
+  return {'config': config,
+          'images': num_imgs,
+          'seconds': elapsed,
+          'images_per_sec': num_imgs / elapsed,
+          'stages': dp.timings.report()}
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--data_dir', help = 'An existing imagenet directory to read instead of a synthetic one')
+  parser.add_argument('--num_categories', help = 'The number of synthetic categories', default = 4, type = int)
+  parser.add_argument('--images_per_category', help = 'The number of images used from every category', default = 64, type = int)
+  parser.add_argument('--batch_size', help = 'The number of images per batch', default = 32, type = int)
+  parser.add_argument('--num_batches', help = 'The number of batches loaded per configuration', default = 8, type = int)
+  parser.add_argument('--workers', help = 'The decode worker counts to try', default = '2,4')
+  parser.add_argument('--output', help = 'Where to write the JSON report, default stdout')
+  parser.add_argument('--read_ahead', help = 'The number of batches read ahead in the read-ahead configurations', default = 4, type = int)
+  parser.add_argument('--cold', help = 'Drop the images from the page cache before every configuration', action = 'store_true')
+  parser.add_argument('--seed', help = 'The seed of the synthetic images', default = 0, type = int)
+  args = parser.parse_args()
+
+  tmp_dir = None
+  data_dir = args.data_dir
+  if data_dir is None:
+    tmp_dir = tempfile.mkdtemp(prefix = 'striate-bench-')
+    data_dir = join(tmp_dir, 'imagenet')
+    util.log('Building synthetic imagenet tree in %s', data_dir)
+    build_tree(data_dir, args.num_categories, args.images_per_category, args.seed)
+
+  worker_counts = util.string_to_int_list(args.workers)
+  configs = [{'num_workers': 0}, {'num_workers': 0, 'prefetch': 2, 'num_readers': 2}]
+  for workers in worker_counts:
+    configs.append({'num_workers': workers})
+    configs.append({'num_workers': workers, 'prefetch': 2, 'num_readers': 2})
+  configs.append({'num_workers': 0, 'cache_bytes': 2 ** 30})
+  configs.append({'num_workers': max(worker_counts), 'cache_bytes': 2 ** 30, 'prefetch': 2, 'num_readers': 2})
+  configs.append({'num_workers': 0, 'read_ahead': args.read_ahead})
+  configs.append({'num_workers': max(worker_counts), 'read_ahead': args.read_ahead, 'prefetch': 2, 'num_readers': 2})
+
+  results = []
+  try:
+    for config in configs:
+      rounds = 2 if config.get('cache_bytes') else 1
+      result = run(data_dir, range(args.images_per_category), args.batch_size, args.num_batches, rounds, config,
+                   args.cold)
+      util.log('%s: %.1f images/sec', config, result['images_per_sec'])
+      results.append(result)
+  finally:
+    if tmp_dir is not None:
+      shutil.rmtree(tmp_dir, ignore_errors = True)
+
+  report = {'data_dir': args.data_dir or 'synthetic', 'batch_size': args.batch_size, 'cold': args.cold,
+            'num_batches': args.num_batches, 'results': results}
+  out = open(args.output, 'w') if args.output else sys.stdout
+  json.dump(report, out, indent = 2, sort_keys = True)
+  out.write('\n')
+
+
+if __name__ == '__main__':
+  main()
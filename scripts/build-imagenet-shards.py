@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+'''
+Pack an ImageNet directory tree (data_dir/n<synid>/*.jpg) into large uint8
+shards for the 'imagenetshard' data provider.  Images are listed through the
+image manifest of data_dir and resized like the imagenet provider does: short
+side scaled to img_size, then center cropped.
+
+The output directory gets:
+  shard-00000.npy ...  uint8 arrays of shape (count, 3, img_size, img_size)
+  labels.npy           int32 label of every packed image, in shard order
+  shards.meta          pickled index: shard file names, counts and offsets
+plus copies of batches.meta and image-mean.pickle from the source directory.
+
+Images are shuffled before packing so that every contiguous run inside a shard
+mixes all categories.
+'''
+
+from os.path import join
+from striate import decoder
+from striate.manifest import load_manifest
+import argparse
+import cPickle
+import numpy as np
+import os
+import shutil
+import sys
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--data_dir', help = 'The imagenet directory with one n<synid> directory per category', required = True)
+  parser.add_argument('--output_dir', help = 'Where to write the shards', required = True)
+  parser.add_argument('--images_per_shard', help = 'The number of images in every shard', default = 10000, type = int)
+  parser.add_argument('--img_size', help = 'The size images are packed at', default = 256, type = int)
+  parser.add_argument('--seed', help = 'The seed used to shuffle the images', default = 0, type = int)
+  args = parser.parse_args()
+
+  meta = cPickle.load(open(join(args.data_dir, 'batches.meta'), 'rb'))
+  synid_to_label = meta['synid_to_label']
+
+  manifest = load_manifest(args.data_dir, synid_to_label)
+  labelled = np.flatnonzero(manifest.labels >= 0)
+  if len(labelled) < len(manifest):
+    print >> sys.stderr, 'Skipping %d images whose synid is not in synid_to_label' % (len(manifest) - len(labelled))
+
+  order = labelled[np.random.RandomState(args.seed).permutation(len(labelled))]
+  names = manifest.full_paths(order)
+  labels = manifest.labels[order]
+
+  if not os.path.exists(args.output_dir):
+    os.makedirs(args.output_dir)
+
+  shape = (3, args.img_size, args.img_size)
+  shards, counts, offsets = [], [], []
+  for offset in range(0, len(names), args.images_per_shard):
+    chunk = names[offset:offset + args.images_per_shard]
+    shard_name = 'shard-%05d.npy' % len(shards)
+    out = np.lib.format.open_memmap(join(args.output_dir, shard_name), mode = 'w+',
+                                    dtype = np.uint8, shape = (len(chunk),) + shape)
+    for i, filename in enumerate(chunk):
+      out[i] = decoder.load_image(filename, args.img_size)
+    out.flush()
+    del out
+
+    shards.append(shard_name)
+    counts.append(len(chunk))
+    offsets.append(offset)
+    print >> sys.stderr, 'Wrote %s (%d images)' % (shard_name, len(chunk))
+
+  np.save(join(args.output_dir, 'labels.npy'), labels)
+
+  shard_meta = {'shards': shards, 'counts': counts, 'offsets': offsets, 'img_size': args.img_size}
+  with open(join(args.output_dir, 'shards.meta'), 'wb') as f:
+    cPickle.dump(shard_meta, f, protocol = -1)
+
+  for name in ['batches.meta', 'image-mean.pickle']:
+    if os.path.exists(join(args.data_dir, name)):
+      shutil.copy(join(args.data_dir, name), join(args.output_dir, name))
+
+  print >> sys.stderr, 'Packed %d images into %d shards' % (len(names), len(shards))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+'''
+Prepare an ImageNet directory tree (data_dir/n<synid>/*.JPEG) for the imagenet
+data providers, using every core.
+
+Every image is decoded and resized to img_size x img_size (short side scaling
+and a center crop, see decoder.load_image) by a pool of worker processes.
+Images that fail to decode are reported and skipped.  With --output_dir the
+resized images are written to output_dir/n<synid>/; otherwise only the
+metadata is written next to the source images.
+
+The output directory gets:
+  batches.meta        label_names, synid_to_label and label_to_synid
+  image-mean.pickle   {'data': the mean image, float32 of length 3*size*size in
+                      (channel, row, col) order}
+  images.manifest.npz the image list, see striate/manifest.py
+
+Each worker reduces one chunk of images at a time to a (count, mean) pair and
+the chunk results are merged pairwise in float64, so memory stays at one chunk
+per worker and the mean does not drift over a million images.
+'''
+
+from PIL import Image
+from os.path import dirname, join
+from striate import decoder, util
+from striate.manifest import load_manifest
+import argparse
+import cPickle
+import multiprocessing
+import numpy as np
+import os
+import re
+import sys
+
+
+def load_synset_names(filename):
+  names = {}
+  for line in open(filename):
+    line = line.strip()
+    if line:
+      synid, name = re.split(' ', line, maxsplit = 1)
+      names[synid] = name.split(',')[0]
+  return names
+
+
+def process_chunk(task):
+  '''
+  Resize the (source, target) images of a chunk, writing them to target when
+  it is not None, and return (count, mean image, failed sources).
+  '''
+  pairs, img_size = task
+  total = np.zeros((3, img_size, img_size), dtype = np.float64)
+  count = 0
+  failed = []
+  for source, target in pairs:
+    try:
+      img = decoder.load_image(source, img_size)
+      if target is not None:
+        Image.fromarray(img.transpose(1, 2, 0)).save(target, 'JPEG', quality = 95)
+    except Exception, e:
+      failed.append((source, str(e)))
+      continue
+    total += img
+    count += 1
+  if count > 0:
+    total /= count
+  return count, total, failed
+
+
+class PairwiseMean(object):
+  '''
+  Merges (count, mean) pairs like a binary counter: partial results of equal
+  rank are merged with each other, so every image passes through O(log n)
+  merges of similarly sized partial means.
+  '''
+  def __init__(self):
+    self._stack = []
+
+  @staticmethod
+  def _merge(a, b):
+    count = a[0] + b[0]
+    if count == 0:
+      return a
+    return count, a[1] + (b[1] - a[1]) * (float(b[0]) / count)
+
+  def add(self, count, mean):
+    rank, item = 0, (count, mean)
+    while self._stack and self._stack[-1][0] == rank:
+      _, top = self._stack.pop()
+      item = self._merge(top, item)
+      rank += 1
+    self._stack.append((rank, item))
+
+  def result(self):
+    item = (0, None)
+    for _, partial in reversed(self._stack):
+      item = partial if item[1] is None else self._merge(partial, item)
+    return item
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--data_dir', help = 'The imagenet directory with one n<synid> directory per category', required = True)
+  parser.add_argument('--output_dir', help = 'Where to write the resized images; without it only the metadata is written, into data_dir')
+  parser.add_argument('--img_size', help = 'The size images are resized to', default = 256, type = int)
+  parser.add_argument('--num_workers', help = 'The number of worker processes', default = multiprocessing.cpu_count(), type = int)
+  parser.add_argument('--chunk_size', help = 'The number of images a worker handles per task', default = 256, type = int)
+  parser.add_argument('--synsets', help = 'The synset names file', default = join(dirname(os.path.abspath(__file__)), 'fall11_synsets.txt'))
+  args = parser.parse_args()
+
+  output_dir = args.output_dir or args.data_dir
+  dirs = sorted(d for d in os.listdir(args.data_dir)
+                if d.startswith('n') and os.path.isdir(join(args.data_dir, d)))
+  label_to_synid = [d[1:] for d in dirs]
+  synid_to_label = dict((synid, label) for label, synid in enumerate(label_to_synid))
+  synset_names = load_synset_names(args.synsets) if os.path.exists(args.synsets) else {}
+
+  pairs = []
+  for d in dirs:
+    if args.output_dir and not os.path.exists(join(output_dir, d)):
+      os.makedirs(join(output_dir, d))
+    for f in sorted(os.listdir(join(args.data_dir, d))):
+      if f.lower().endswith(('.jpg', '.jpeg')):
+        target = join(output_dir, d, f) if args.output_dir else None
+        pairs.append((join(args.data_dir, d, f), target))
+  util.log('Preparing %d images in %d categories with %d workers', len(pairs), len(dirs), args.num_workers)
+
+  tasks = [(pairs[i:i + args.chunk_size], args.img_size) for i in range(0, len(pairs), args.chunk_size)]
+  pool = multiprocessing.Pool(args.num_workers)
+  mean = PairwiseMean()
+  failed = []
+  try:
+    for i, (count, chunk_mean, chunk_failed) in enumerate(pool.imap_unordered(process_chunk, tasks)):
+      mean.add(count, chunk_mean)
+      failed.extend(chunk_failed)
+      if (i + 1) % 100 == 0:
+        util.log('%d/%d chunks', i + 1, len(tasks))
+  finally:
+    pool.terminate()
+    pool.join()
+
+  for source, error in failed:
+    print >> sys.stderr, 'Failed to decode %s: %s' % (source, error)
+
+  count, mean_image = mean.result()
+  assert count > 0, 'No image could be decoded'
+
+  meta = {'label_names': [synset_names.get(s, s) for s in label_to_synid],
+          'synid_to_label': synid_to_label,
+          'label_to_synid': label_to_synid}
+  with open(join(output_dir, 'batches.meta'), 'wb') as f:
+    cPickle.dump(meta, f, protocol = -1)
+  with open(join(output_dir, 'image-mean.pickle'), 'wb') as f:
+    cPickle.dump({'data': mean_image.astype(np.float32).reshape(-1)}, f, protocol = -1)
+
+  if args.output_dir:
+    load_manifest(output_dir, synid_to_label)
+  util.log('Prepared %d images (%d failed) in %s', count, len(failed), output_dir)
+
+
+if __name__ == '__main__':
+  main()
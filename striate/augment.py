@@ -0,0 +1,31 @@
+from numpy.lib.stride_tricks import as_strided
+import numpy as np
+
+
+def crop_windows(images, size):
+  '''
+  A view of every size x size window of a stack of (N, C, H, W) images, with
+  shape (N, C, H - size + 1, W - size + 1, size, size).  Nothing is copied.
+  '''
+  n, c, h, w = images.shape
+  sn, sc, sh, sw = images.strides
+  return as_strided(images, shape=(n, c, h - size + 1, w - size + 1, size, size),
+                    strides=(sn, sc, sh, sw, sh, sw))
+
+
+def batch_crop_flip(images, start_y, start_x, size, flip, target, src=None):
+  '''
+  Crop image src[i] of `images` (N, C, H, W) at (start_y[i], start_x[i]),
+  mirror it horizontally if flip[i] and write it to column i of `target`,
+  a (C * size * size, >= len(start_y)) batch-minor matrix.  src defaults to
+  arange(len(start_y)).
+  '''
+  num = len(start_y)
+  if src is None:
+    src = np.arange(num)
+  flip = np.asarray(flip, dtype=bool)
+
+  windows = crop_windows(images, size)
+  crops = windows[src, :, start_y, start_x]
+  crops[flip] = crops[flip][:, :, :, ::-1]
+  target[:, :num] = crops.reshape((num, -1)).T
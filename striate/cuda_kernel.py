@@ -509,7 +509,7 @@ _matrix_add_ = CompiledSource('''
 _gpu_partial_copy_to_ = CompiledSource('''
     __global__
     void gpu_partial_copy_to(float* src, float* dest, int row_from, int row_to, int col_from, int
-    col_to, int sleading, int dleading) {
+    col_to, int dest_col, int sleading, int dleading) {
       int i = blockIdx.x * blockDim.x + threadIdx.x;
       int j = blockIdx.y * blockDim.y + threadIdx.y;
 
@@ -517,7 +517,7 @@ _gpu_partial_copy_to_ = CompiledSource('''
       if( j >= row_to - row_from) return;
 
       int sidx = i+col_from  + (j+ row_from) * sleading;
-      int didx = i+ j  * dleading;
+      int didx = i + dest_col + j * dleading;
 
       dest[didx] = src[sidx];
     }''', 'gpu_partial_copy_to')
@@ -875,7 +875,11 @@ def gpu_copy_to(x, y):
   pycuda.driver.memcpy_dtod(y.gpudata, x.gpudata, x.nbytes)
   timer.end("gpu_copy_to")
 
-def gpu_partial_copy_to(x, y, row_from, row_to, col_from, col_to):
+def gpu_partial_copy_to(x, y, row_from, row_to, col_from, col_to, dest_col=0):
+  '''
+  Copy x[row_from:row_to, col_from:col_to] into the top rows of y, starting at
+  column dest_col.
+  '''
   timer.start()
   mh, mw = x.shape
   row_to = min(row_to, mh)
@@ -885,7 +889,8 @@ def gpu_partial_copy_to(x, y, row_from, row_to, col_from, col_to):
   block = (32, 32, 1)
   grid = (divup(c, 32), divup(r, 32))
   sleading, dleading = x.strides[0] / 4, y.strides[0] / 4
-  _gpu_partial_copy_to_(x, y, I(row_from), I(row_to), I(col_from), I(col_to), I(sleading), I(dleading), block=block, grid=grid)
+  _gpu_partial_copy_to_(x, y, I(row_from), I(row_to), I(col_from), I(col_to), I(dest_col), I(sleading), I(dleading),
+                        block=block, grid=grid)
   timer.end('gpu_partial_copy_to')
 
 def dot(x, y):
@@ -1,12 +1,7 @@
-from PIL import Image
-from pycuda import gpuarray, driver
-from striate.cuda_kernel import gpu_partial_copy_to, print_matrix
-from os.path import basename
-from striate import util
-import Queue
-import cPickle
+from striate.manifest import TarManifest, load_category_index
+from striate import augment, dataservice, decoder, readahead, util
 import collections
-import glob
+import hashlib
 import numpy as np
 import os
 import random
@@ -14,16 +9,101 @@ import re
 import sys
 import threading
 import time
+import weakref
 BatchData = collections.namedtuple('BatchData',
                                    ['data', 'labels', 'epoch'])
 
 
-dp_dict = {}
+# pycuda and the kernels are only imported once a batch goes to the GPU, so
+# that the host side (data service, benchmarks) runs on machines without one
+cuda_kernel = util.LazyModule('striate.cuda_kernel')
+# striate.cuda_kernel sets up the CUDA context
+gpuarray = util.LazyModule('pycuda.gpuarray', 'striate.cuda_kernel')
 
+dp_dict = {}
+# mean images already loaded by this process, see ImageNetDataProvider._load_data_mean
+_mean_cache = {}
+
+
+class BufferPool(object):
+  '''
+  Recycles host arrays of a fixed shape and dtype.  Providers fill a buffer
+  from get() in place and hand it out; the consumer gives it back with put()
+  once the batch is on the GPU.  put() ignores arrays this pool did not create,
+  so providers may also hand out views of their own storage.  Buffers that are
+  never put back are freed as usual.
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._free = collections.defaultdict(list)
+    self._owned = weakref.WeakValueDictionary()
+
+  def __len__(self):
+    # buffers alive, free or in use
+    with self._lock:
+      return len(self._owned)
+
+  def get(self, shape, dtype=np.float32):
+    key = (tuple(shape), np.dtype(dtype))
+    with self._lock:
+      if self._free[key]:
+        return self._free[key].pop()
+    buf = np.empty(shape, dtype=dtype)
+    with self._lock:
+      self._owned[id(buf)] = buf
+    return buf
+
+  def put(self, buf):
+    with self._lock:
+      if self._owned.get(id(buf)) is buf:
+        self._free[(buf.shape, buf.dtype)].append(buf)
+
+
+class BatchCache(object):
+  '''
+  Keeps the preprocessed batches of a deterministic provider, in memory or as
+  .npy files under cache_dir that are read back through memmaps.  The files
+  are dropped when `signature`, a digest of what they were built from, changes.
+  '''
+  def __init__(self, signature, cache_dir=None):
+    self.cache_dir = cache_dir
+    self._batches = {}
+    if cache_dir is None:
+      return
+
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    signature_file = os.path.join(cache_dir, 'signature')
+    if not os.path.exists(signature_file) or open(signature_file).read() != signature:
+      util.log('Clearing stale batch cache %s', cache_dir)
+      for f in os.listdir(cache_dir):
+        if f.startswith('batch-'):
+          os.remove(os.path.join(cache_dir, f))
+      with open(signature_file, 'w') as f:
+        f.write(signature)
+
+  def _filename(self, batch):
+    return os.path.join(self.cache_dir, 'batch-%d.npy' % batch)
+
+  def get(self, batch):
+    data = self._batches.get(batch)
+    if data is None and self.cache_dir is not None and os.path.exists(self._filename(batch)):
+      data = self._batches[batch] = np.load(self._filename(batch), mmap_mode='r')
+    return data
+
+  def put(self, batch, data):
+    if self.cache_dir is None:
+      self._batches[batch] = data.copy()
+      return
+    filename = self._filename(batch)
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+      np.save(f, data)
+    os.rename(tmp, filename)
 
 
 class DataProvider(object):
-  def __init__(self, data_dir='.', batch_range=None):
+  def __init__(self, data_dir='.', batch_range=None, fixed_batch_size=False):
     self.data_dir = data_dir
     self.meta_file = os.path.join(data_dir, 'batches.meta')
 
@@ -46,9 +126,18 @@ class DataProvider(object):
     self.data = None
     self.labels = None
     self.index = 0
+    self.buffers = BufferPool()
+    self.timings = util.StageTimer()
+    # the iteration state from before the batch the consumer is reading, see get_state
+    self._batch_state = None
+    # stitch the tail of a batch with the head of the next one, so that every
+    # minibatch has exactly batch_size columns
+    self.fixed_batch_size = fixed_batch_size
 
   def copy_to_GPU(self):
-      self.data_on_GPU = gpuarray.to_gpu(self.data.astype(np.float32))
+    self.data_on_GPU = gpuarray.to_gpu(np.require(self.data, dtype=np.float32, requirements='C'))
+    self.buffers.put(self.data)
+    self.data = None
 
   def reset(self):
     self.curr_batch_index = 0
@@ -60,29 +149,126 @@ class DataProvider(object):
     self.data_on_GPU = None
     self.data = None
     self.labels = None
-
+    self.index = 0
+    self._batch_state = None
+
+  def _iteration_state(self):
+    '''
+    Everything _advance depends on, taken before it moves to the next batch.
+    '''
+    return {'batch_range': list(self.batch_range),
+            'batch_index': self.curr_batch_index,
+            'epoch': self.curr_epoch,
+            'random_state': random.getstate(),
+            'np_random_state': np.random.get_state()}
+
+  def _restore_iteration(self, state):
+    self.batch_range = list(state['batch_range'])
+    self.curr_batch_index = state['batch_index']
+    self.curr_epoch = state['epoch']
+    random.setstate(state['random_state'])
+    np.random.set_state(state['np_random_state'])
+
+  def get_state(self):
+    '''
+    The position of the consumer: the batch order, batch index, epoch and
+    random generator states from before the batch being read, and the column
+    `index` reached in it.  set_state on a provider over the same batches
+    continues from the same sample.
+    '''
+    state = self._batch_state if self._batch_state is not None else self._iteration_state()
+    return dict(state, index=self.index)
+
+  def _check_state(self, state):
+    '''
+    Raise ValueError unless set_state can continue from `state`, e.g. one saved
+    by another kind of provider or by an older version.
+    '''
+    keys = self._iteration_state().keys() + ['index']
+    missing = [k for k in keys if not isinstance(state, dict) or k not in state]
+    if missing:
+      raise ValueError('The saved position has no %s' % ', '.join(sorted(missing)))
+    if sorted(state['batch_range']) != sorted(self.batch_range):
+      raise ValueError('The saved position is over different batches')
+
+  def set_state(self, state):
+    self._check_state(state)
+    self.reset()
+    self._restore_iteration(state)
+    self.index = state['index']
+
+  def close(self):
+    '''
+    Release the threads, processes and files of the provider.  It cannot be
+    used afterwards.
+    '''
+    pass
 
   def get_next_index(self):
     self.curr_batch_index = (self.curr_batch_index + 1) % len(self.batch_range)
     return self.curr_batch_index
 
+  def _start_epoch(self):
+    random.shuffle(self.batch_range)
+    self.curr_epoch += 1
+
+  def _advance(self):
+    '''
+    Move to the next batch and return (batch, epoch).  `batch` is whatever
+    _load_batch takes to load that batch.
+    '''
+    self.get_next_index()
+    if self.curr_batch_index == 0:
+      self._start_epoch()
+    self.curr_batch = self.batch_range[self.curr_batch_index]
+    return self.curr_batch, self.curr_epoch
+
+  def _load_batch(self, batch):
+    '''
+    Load a batch, returning (data, labels) with data laid out as (dims, num).
+    Must not touch the iteration state, so that several readers can load
+    batches at the same time.
+    '''
+    raise NotImplementedError
+
+  def _get_next_batch(self):
+    self._batch_state = self._iteration_state()
+    batch, epoch = self._advance()
+    self.data, self.labels = self._load_batch(batch)
+
   def get_next_batch(self, batch_size):
     if self.data_on_GPU is  None:
       self._get_next_batch()
       self.copy_to_GPU()
 
     height, width = self.data_on_GPU.shape
+    if self.fixed_batch_size and self.index + batch_size > width:
+      data = gpuarray.zeros((height, batch_size), dtype = np.float32)
+      labels = []
+      filled = 0
+      while filled < batch_size:
+        if self.index == self.data_on_GPU.shape[1]:
+          self._get_next_batch()
+          self.copy_to_GPU()
+          self.index = 0
+        num = min(batch_size - filled, self.data_on_GPU.shape[1] - self.index)
+        cuda_kernel.gpu_partial_copy_to(self.data_on_GPU, data, 0, height, self.index, self.index + num, dest_col = filled)
+        labels.append(self.labels[self.index:self.index + num])
+        self.index += num
+        filled += num
+      return BatchData(data, np.concatenate(labels), self.curr_epoch)
+
     if self.index + batch_size >  width:
       labels = self.labels[self.index:]
       width = width - self.index
       data = gpuarray.zeros((height, width), dtype = np.float32)
-      gpu_partial_copy_to(self.data_on_GPU, data, 0, height, self.index, self.index + width)
+      cuda_kernel.gpu_partial_copy_to(self.data_on_GPU, data, 0, height, self.index, self.index + width)
       self._get_next_batch()
       self.copy_to_GPU()
       self.index = 0
     else:
       data = gpuarray.zeros((height, batch_size), dtype = np.float32)
-      gpu_partial_copy_to(self.data_on_GPU, data, 0, height, self.index, self.index + batch_size)
+      cuda_kernel.gpu_partial_copy_to(self.data_on_GPU, data, 0, height, self.index, self.index + batch_size)
       labels = self.labels[self.index:self.index + batch_size]
       self.index += batch_size
     return BatchData(data, labels, self.curr_epoch)
@@ -113,196 +299,602 @@ class DataProvider(object):
       return dp_dict[name]
 
 
+class BatchPrefetcher(object):
+  '''
+  Keeps up to `depth` batches of a provider loaded ahead of the consumer, using
+  `num_readers` reader threads.  The order of the batches and their epoch are
+  decided under a lock by provider._advance(), so get() hands batches out in
+  that order no matter which reader finished first.
+  '''
+  def __init__(self, provider, depth, num_readers):
+    self.provider = provider
+    self._slots = threading.Semaphore(depth)
+    self._cond = threading.Condition()
+    self._ready = {}
+    self._next_seq = 0
+    self._out_seq = 0
+    self._stopped = False
+    # the provider's iteration state from before the last batch get() returned
+    self.state = None
+
+    self._readers = []
+    for i in range(num_readers):
+      reader = threading.Thread(target=self._run)
+      reader.setDaemon(True)
+      reader.start()
+      self._readers.append(reader)
+
+  def _run(self):
+    while 1:
+      self._slots.acquire()
+      with self._cond:
+        if self._stopped:
+          return
+        seq = self._next_seq
+        self._next_seq += 1
+        state = self.provider._iteration_state()
+        try:
+          batch, epoch = self.provider._advance()
+        except Exception:
+          batch, epoch, item = None, None, (None, None, None, sys.exc_info(), state)
+
+      if batch is not None:
+        try:
+          data, labels = self.provider._load_batch(batch)
+          item = (data, labels, epoch, None, state)
+        except Exception:
+          util.log('Failed to load batch %s', batch, exc_info=True)
+          item = (None, None, epoch, sys.exc_info(), state)
+
+      with self._cond:
+        if self._stopped:
+          # nobody will get() it any more
+          self._recycle(item)
+          return
+        self._ready[seq] = item
+        self._cond.notify_all()
+
+  def _recycle(self, item):
+    if item[0] is not None:
+      self.provider.buffers.put(item[0])
+
+  def get(self):
+    with self._cond:
+      while self._out_seq not in self._ready:
+        self._cond.wait()
+      data, labels, epoch, exc_info, self.state = self._ready.pop(self._out_seq)
+      self._out_seq += 1
+    self._slots.release()
+
+    if exc_info is not None:
+      raise exc_info[0], exc_info[1], exc_info[2]
+    return data, labels, epoch
+
+  def stop(self):
+    with self._cond:
+      self._stopped = True
+      for item in self._ready.itervalues():
+        self._recycle(item)
+      self._ready.clear()
+    for reader in self._readers:
+      self._slots.release()
+
+  def join(self):
+    '''
+    Wait for the readers to finish the batches they are loading, after stop().
+    '''
+    for reader in self._readers:
+      reader.join()
+
+
 class ParallelDataProvider(DataProvider):
-  def __init__(self, data_dir='.', batch_range=None):
-    DataProvider.__init__(self, data_dir, batch_range)
-    self._reader = None
-    self._batch_return = None
-    self._data_queue = Queue.Queue(1)
-    self._command_queue = Queue.Queue(1)
+  def __init__(self, data_dir='.', batch_range=None, prefetch=1, num_readers=1, fixed_batch_size=False,
+               on_host=False, shuffle_window=1):
+    DataProvider.__init__(self, data_dir, batch_range, fixed_batch_size)
+    self.prefetch = prefetch
+    self.num_readers = num_readers
+    # keep batches in host memory, batch-major, and hand out minibatches as
+    # (dims, batch_size) views of them instead of copies on the GPU
+    self.on_host = on_host
+    self._prefetcher = None
     self.reserved_epoch = 0
     self.reserved_labels = None
     self.reserved_data_on_GPU = None
+    self.reserved_data = None
+    self._retired_data = None
+    # mix the samples of `shuffle_window` consecutive batches of an epoch; the
+    # consumer draws from its own generator, so it never races the readers
+    self.shuffle_window = shuffle_window
+    self._window_rng = np.random.RandomState(np.random.randint(2 ** 31))
+    self._reset_window()
 
   def _start_read(self):
-    assert self._reader is None
-    self._reader = threading.Thread(target=self.run_in_back)
-    self._reader.setDaemon(True)
-    self._reader.start()
-    self._command_queue.put(1)
+    assert self._prefetcher is None
+    self._prefetcher = BatchPrefetcher(self, self.prefetch, self.num_readers)
 
   def reset(self):
+    if self._prefetcher is not None:
+      self._prefetcher.stop()
+    self._prefetcher = None
+    # hand back the batches loaded for the old position
+    for buf in [self.reserved_data, self._retired_data, self._window_data]:
+      if buf is not None:
+        self.buffers.put(buf)
+    if self._pending is not None:
+      self.buffers.put(self._pending[0][0])
     DataProvider.reset(self)
-    self._reader = None
-    self._batch_return = None
-    self._data_queue = Queue.Queue(1)
-    self._command_queue = Queue.Queue(1)
     self.reserved_epoch = 0
     self.reserved_labels = None
     self.reserved_data_on_GPU = None
-
-
-  def run_in_back(self):
-    while 1:
-      self._command_queue.get()
-      self._get_next_batch()
-      self._data_queue.put(1)
+    self.reserved_data = None
+    self._retired_data = None
+    self._reset_window()
+
+  def _reset_window(self):
+    self._window_data = None
+    self._window_labels = None
+    self._window_chunks = []
+    self._window_epoch = 0
+    self._window_perm = None
+    self._window_size = 0
+    self._window_state = None
+    self._pending = None
+    # (perm, chunk) of a window being resumed, see set_state
+    self._resume_window = None
+
+  def _next_batch_from_prefetcher(self):
+    if self._pending is not None:
+      (item, state), self._pending = self._pending, None
+      return item, state
+    item = self._prefetcher.get()
+    return item, self._prefetcher.state
+
+  def _fill_window(self):
+    '''
+    Load the next `shuffle_window` batches of the current epoch, in the order
+    the provider reads them, and permute their samples together.
+    '''
+    if self._window_data is not None:
+      self.buffers.put(self._window_data)
+
+    first, self._window_state = self._next_batch_from_prefetcher()
+    batches = [first]
+    epoch = first[2]
+    while len(batches) < self.shuffle_window:
+      item, state = self._next_batch_from_prefetcher()
+      if item[2] != epoch:
+        # never mix samples of two epochs
+        self._pending = (item, state)
+        break
+      batches.append(item)
+
+    total = sum(data.shape[1] for data, _, _ in batches)
+    self._window_data = self.buffers.get((batches[0][0].shape[0], total), np.float32)
+    np.concatenate([data for data, _, _ in batches], axis=1, out=self._window_data)
+    self._window_labels = np.concatenate([np.asarray(labels) for _, labels, _ in batches])
+    for data, _, _ in batches:
+      self.buffers.put(data)
+
+    skip = 0
+    if self._resume_window is not None:
+      self._window_perm, skip = self._resume_window
+      self._resume_window = None
+      assert len(self._window_perm) == total, 'The resumed window holds different batches'
+    else:
+      self._window_perm = self._window_rng.permutation(total)
+    self._window_chunks = np.array_split(self._window_perm, len(batches))[skip:]
+    self._window_size = len(batches)
+    self._window_epoch = epoch
+
+  def _next_mixed_batch(self):
+    if not self._window_chunks:
+      self._fill_window()
+    index = self._window_chunks.pop(0)
+    data = self.buffers.get((self._window_data.shape[0], len(index)), np.float32)
+    np.take(self._window_data, index, axis=1, out=data)
+    return data, self._window_labels[index], self._window_epoch
+
+  def _wait_batch(self):
+    if self._prefetcher is None:
+      self._start_read()
+    with self.timings('wait'):
+      if self.shuffle_window > 1:
+        data, labels, epoch = self._next_mixed_batch()
+        self._batch_state = self._window_state
+      else:
+        data, labels, epoch = self._prefetcher.get()
+        self._batch_state = self._prefetcher.state
+    return BatchData(data, labels, epoch)
+
+  def iter_batches(self, num_batches=None):
+    '''
+    Yield the next num_batches whole batches (forever if None) in host memory,
+    as BatchData of a (dims, num) float32 array, its labels and epoch.  For
+    consumers that do not train on the GPU, such as the data service and the
+    benchmarks; hand every array back with buffers.put() once done with it.
+    The time spent waiting for the readers goes to timings['wait'].
+    '''
+    count = 0
+    while num_batches is None or count < num_batches:
+      yield self._wait_batch()
+      count += 1
 
   def _fill_reserved_data(self):
-    self._data_queue.get()
-    self.copy_to_GPU()
-    self.reserved_epoch = self.curr_epoch
-    self.reserved_labels = self.labels.copy()
-    self.reserved_data_on_GPU = self.data_on_GPU.copy()
+    data, labels, epoch = self._wait_batch()
+    self.reserved_epoch = epoch
+    self.reserved_labels = labels
+    if self.on_host:
+      host = self.buffers.get(data.shape[::-1], np.float32)
+      host[...] = data.T
+      self.buffers.put(data)
+      # the last minibatch handed out may still view the current batch, so it
+      # is only recycled on the refill after this one
+      if self._retired_data is not None:
+        self.buffers.put(self._retired_data)
+      self._retired_data = self.reserved_data
+      self.reserved_data = host
+      assert self.reserved_data.shape[0] == self.reserved_labels.shape[0]
+      return
+
+    if not data.flags.c_contiguous and data.T.flags.c_contiguous:
+      # batch-major storage such as a feature shard: upload it as is and transpose on the GPU
+      self.reserved_data_on_GPU = cuda_kernel.transpose(gpuarray.to_gpu(np.require(data.T, dtype=np.float32)))
+      self.buffers.put(data)
+      assert self.reserved_data_on_GPU.shape[1] == self.reserved_labels.shape[0]
+      return
+
+    host = np.require(data, dtype=np.float32, requirements='C')
+    # minibatches are copied out of the reserved batch, so its GPU memory can be reused
+    if self.reserved_data_on_GPU is not None and self.reserved_data_on_GPU.shape == host.shape:
+      self.reserved_data_on_GPU.set(host)
+    else:
+      self.reserved_data_on_GPU = gpuarray.to_gpu(host)
+    self.buffers.put(data)
     assert self.reserved_data_on_GPU.shape[1] == self.reserved_labels.shape[0]
-    self._command_queue.put(1)
+
+  def get_state(self):
+    '''
+    With shuffle_window > 1 the position is the first batch of the current
+    window, its permutation, the chunk of it being read and the state of the
+    window generator.
+    '''
+    state = DataProvider.get_state(self)
+    if self.shuffle_window > 1:
+      state['window_rng_state'] = self._window_rng.get_state()
+      if self._window_perm is not None:
+        state['window'] = (self._window_perm, self._window_size - len(self._window_chunks) - 1)
+    return state
+
+  def set_state(self, state):
+    DataProvider.set_state(self, state)
+    if 'window_rng_state' in state:
+      self._window_rng.set_state(state['window_rng_state'])
+    self._resume_window = state.get('window')
+
+  def close(self):
+    if self._prefetcher is not None:
+      self._prefetcher.stop()
+      self._prefetcher.join()
+    self._prefetcher = None
 
   def get_next_batch(self, batch_size):
-    if self._reader is None:
+    if self._prefetcher is None:
       self._start_read()
 
-    if self.data_on_GPU is None:
+    if self.on_host:
+      return self._next_host_batch(batch_size)
+
+    if self.reserved_data_on_GPU is None:
       self._fill_reserved_data()
 
     height, width = self.reserved_data_on_GPU.shape
+    if self.fixed_batch_size and self.index + batch_size >= width:
+      return self._stitch_batch(batch_size)
+
     if self.index + batch_size >=  width:
       labels = self.reserved_labels[self.index:]
       width = width - self.index
       data = gpuarray.zeros((height, width), dtype = np.float32)
-      gpu_partial_copy_to(self.reserved_data_on_GPU, data, 0, height, self.index, self.index + width)
+      cuda_kernel.gpu_partial_copy_to(self.reserved_data_on_GPU, data, 0, height, self.index, self.index + width)
       self.index = 0
       self._fill_reserved_data()
     else:
       data = gpuarray.zeros((height, batch_size), dtype = np.float32)
-      gpu_partial_copy_to(self.reserved_data_on_GPU, data, 0, height, self.index, self.index + batch_size)
+      cuda_kernel.gpu_partial_copy_to(self.reserved_data_on_GPU, data, 0, height, self.index, self.index + batch_size)
       labels = self.reserved_labels[self.index:self.index + batch_size]
       self.index += batch_size
     return BatchData(data, labels, self.reserved_epoch)
 
+  def _next_host_batch(self, batch_size):
+    if self.reserved_data is None:
+      self._fill_reserved_data()
 
-
-
-class ImageNetDataProvider(ParallelDataProvider):
-  def __init__(self, data_dir, batch_range=None, category_range=None, batch_size=128):
-    ParallelDataProvider.__init__(self, data_dir, batch_range)
-    self.img_size = 256
-    self.border_size = 16
-    self.inner_size = 224
-    self.batch_size = batch_size
-
-    # self.multiview = dp_params['multiview_test'] and test
-    self.multiview = 0
-    self.num_views = 5 * 2
-    self.data_mult = self.num_views if self.multiview else 1
-
-    self.buffer_idx = 0
-
-    dirs = glob.glob(data_dir + '/n*')
-    synid_to_dir = {}
-    for d in dirs:
-      synid_to_dir[basename(d)[1:]] = d
-
-    if category_range is None:
-      cat_dirs = dirs
+    width = self.reserved_data.shape[0]
+    if self.fixed_batch_size and self.index + batch_size >= width:
+      data = np.empty((batch_size, self.reserved_data.shape[1]), dtype=np.float32)
+      labels = []
+      filled = 0
+      while filled < batch_size:
+        width = self.reserved_data.shape[0]
+        num = min(batch_size - filled, width - self.index)
+        data[filled:filled + num] = self.reserved_data[self.index:self.index + num]
+        labels.append(self.reserved_labels[self.index:self.index + num])
+        self.index += num
+        filled += num
+        if self.index == width:
+          self.index = 0
+          self._fill_reserved_data()
+      return BatchData(data.T, np.concatenate(labels), self.reserved_epoch)
+
+    if self.index + batch_size >= width:
+      data = self.reserved_data[self.index:].T
+      labels = self.reserved_labels[self.index:]
+      self.index = 0
+      self._fill_reserved_data()
     else:
-      cat_dirs = []
-      for i in category_range:
-        synid = self.batch_meta['label_to_synid'][i]
-        # util.log('Using category: %d, synid: %s, label: %s', i, synid, self.batch_meta['label_names'][i])
-        cat_dirs.append(synid_to_dir[synid])
+      data = self.reserved_data[self.index:self.index + batch_size].T
+      labels = self.reserved_labels[self.index:self.index + batch_size]
+      self.index += batch_size
+    return BatchData(data, labels, self.reserved_epoch)
+
+  def _stitch_batch(self, batch_size):
+    height = self.reserved_data_on_GPU.shape[0]
+    data = gpuarray.zeros((height, batch_size), dtype = np.float32)
+    labels = []
+    filled = 0
+    while filled < batch_size:
+      width = self.reserved_data_on_GPU.shape[1]
+      num = min(batch_size - filled, width - self.index)
+      cuda_kernel.gpu_partial_copy_to(self.reserved_data_on_GPU, data, 0, height, self.index, self.index + num, dest_col = filled)
+      labels.append(self.reserved_labels[self.index:self.index + num])
+      self.index += num
+      filled += num
+      if self.index == width:
+        self.index = 0
+        self._fill_reserved_data()
+    return BatchData(data, np.concatenate(labels), self.reserved_epoch)
 
-    self.images = []
-    batch_dict = dict((k, k) for k in self.batch_range)
 
-    for d in cat_dirs:
-      imgs = [v for i, v in enumerate(glob.glob(d + '/*.jpg')) if i in batch_dict]
-      self.images.extend(imgs)
 
-    self.images = np.array(self.images)
 
-    # build index vector into 'images' and split into groups of batch-size
+class ImageNetDataProvider(ParallelDataProvider):
+  def __init__(self, data_dir, batch_range=None, category_range=None, batch_size=128, num_workers=0,
+               manifest_file=None, prefetch=1, num_readers=1, cache_bytes=0,
+               multiview=False, fixed_batch_size=False, on_host=False,
+               shuffle_window=1, resize_cache_dir=None, test=False, batch_cache=False, batch_cache_dir=None,
+               read_ahead=0, read_ahead_threads=4):
+    ParallelDataProvider.__init__(self, data_dir, batch_range, prefetch, num_readers, fixed_batch_size, on_host,
+                                  shuffle_window)
+    self._init_geometry(batch_size, multiview, test)
+    # images that are not img_size x img_size are resized while decoding, and
+    # only those are kept under resize_cache_dir when it is set
+    self.resize_cache_dir = resize_cache_dir
+    if resize_cache_dir is not None and not os.path.exists(resize_cache_dir):
+      os.makedirs(resize_cache_dir)
+
+    index = self._load_index(manifest_file)
+    selected = index.select(self.batch_range, category_range)
+    self.images = index.manifest.full_paths(selected)
+    self.sources = index.manifest.sources(selected)
+    self.image_labels = index.manifest.labels[selected]
+
+    # build index vector into 'images' and split into groups of batch-size;
+    # test batches keep the same images from run to run
     image_index = np.arange(len(self.images))
-    np.random.shuffle(image_index)
+    if not self.test:
+      np.random.shuffle(image_index)
 
-    self.batches = np.array_split(image_index,
-                                  util.divup(len(self.images), batch_size))
+    self.batches = np.array_split(image_index, util.divup(len(self.images), batch_size))
 
     self.batch_range = range(len(self.batches))
 
     util.log('Starting data provider with %d batches', len(self.batches))
     np.random.shuffle(self.batch_range)
 
-    imagemean = cPickle.loads(open(data_dir + "image-mean.pickle").read())
-    self.data_mean = (imagemean['data']
-        .astype(np.single)
-        .T
-        .reshape((3, 256, 256))[:, self.border_size:self.border_size + self.inner_size, self.border_size:self.border_size + self.inner_size]
-        .reshape((self.get_data_dims(), 1)))
-
-
-  def __trim_borders(self, images, target):
-    for idx, img in enumerate(images):
-      # startY, startX = np.random.randint(0, self.border_size * 2 + 1), np.random.randint(0, self.border_size * 2 + 1)
-      startY, startX = 0, 0
-      endY, endX = startY + self.inner_size, startX + self.inner_size
-      pic = img[:, startY:endY, startX:endX]
-      if np.random.randint(2) == 0:  # also flip the image with 50% probability
-        pic = pic[:, :, ::-1]
-      target[:, idx] = pic.reshape((self.get_data_dims(),))
+    self._load_data_mean()
+
+    self.decode_pool = None
+    if num_workers > 0:
+      util.log('Decoding images with %d worker processes', num_workers)
+      self.decode_pool = decoder.DecodePool(num_workers,
+                                            (batch_size, 3, self.img_size, self.img_size),
+                                            num_slots=num_readers, cache_dir=resize_cache_dir)
+
+    self.image_cache = None
+    if cache_bytes > 0:
+      self.image_cache = decoder.ImageCache(cache_bytes, (3, self.img_size, self.img_size))
+      util.log('Caching up to %d decoded images', self.image_cache.capacity)
+
+    # warm the page cache with the images of the `read_ahead` batches after
+    # the one being loaded
+    self.read_ahead = None
+    self.read_ahead_batches = read_ahead
+    self._read_ahead_until = 0
+    if read_ahead > 0:
+      util.log('Reading %d batches ahead with %d threads', read_ahead, read_ahead_threads)
+      self.read_ahead = readahead.ReadAhead(read_ahead_threads)
+
+    # cropped test batches are kept as uint8, before the mean is subtracted
+    self.batch_cache = None
+    if batch_cache or batch_cache_dir is not None:
+      assert self.test, 'Only test batches are deterministic and can be cached'
+      self.batch_cache = BatchCache(self._batch_signature(index.manifest), batch_cache_dir)
+
+  def _load_index(self, manifest_file):
+    return load_category_index(self.data_dir, self.batch_meta['synid_to_label'], manifest_file)
+
+  def _batch_signature(self, manifest):
+    h = hashlib.md5()
+    h.update(repr((os.path.abspath(self.data_dir), self.img_size, self.inner_size, self.multiview)))
+    h.update(manifest.dir_mtimes.tostring())
+    for batch in self.batches:
+      h.update(self.images[batch].tostring())
+    return h.hexdigest()
+
+  def _init_geometry(self, batch_size, multiview=False, test=False):
+    self.img_size = 256
+    self.border_size = 16
+    self.inner_size = 224
+    self.batch_size = batch_size
+    # test batches use the center crop, unflipped
+    self.test = test
+
+    # in multiview mode every image yields num_views consecutive columns: the
+    # four corner crops and the center crop, then the same five mirrored
+    self.multiview = multiview
+    # mixing batches would scatter the views of an image
+    assert not multiview or self.shuffle_window == 1, 'Multiview batches cannot use a shuffle window'
+    self.num_views = 5 * 2
+    self.data_mult = self.num_views if self.multiview else 1
 
-  def _get_next_batch(self):
-    start = time.time()
-    self.get_next_index()
+    self.buffer_idx = 0
 
-    self.curr_batch = self.batch_range[self.curr_batch_index]
-    if self.curr_batch_index == 0:
-      self.curr_epoch += 1
+  def _load_data_mean(self):
+    filename = os.path.join(self.data_dir, 'image-mean.pickle')
+    key = (os.path.abspath(filename), os.path.getmtime(filename), self.border_size, self.inner_size)
+    if key not in _mean_cache:
+      imagemean = util.load(filename)
+      _mean_cache[key] = (imagemean['data']
+          .astype(np.single)
+          .T
+          .reshape((3, 256, 256))[:, self.border_size:self.border_size + self.inner_size, self.border_size:self.border_size + self.inner_size]
+          .reshape((self.get_data_dims(), 1)))
+    self.data_mean = _mean_cache[key]
+
+  def _trim_borders(self, images, target):
+    num_imgs = len(images)
+    if self.multiview:
+      edge = self.border_size * 2
+      corners_y = np.array([0, 0, edge, edge, self.border_size] * 2)
+      corners_x = np.array([0, edge, 0, edge, self.border_size] * 2)
+      flip = np.arange(self.num_views) >= self.num_views / 2
+      augment.batch_crop_flip(images, np.tile(corners_y, num_imgs), np.tile(corners_x, num_imgs),
+                              self.inner_size, np.tile(flip, num_imgs), target,
+                              src=np.repeat(np.arange(num_imgs), self.num_views))
+      return
+
+    if self.test:
+      center = np.repeat(self.border_size, num_imgs)
+      augment.batch_crop_flip(images, center, center, self.inner_size, np.zeros(num_imgs, dtype=bool), target)
+      return
+
+    start_y = np.random.randint(0, self.border_size * 2 + 1, size=num_imgs)
+    start_x = np.random.randint(0, self.border_size * 2 + 1, size=num_imgs)
+    # also flip the image with 50% probability
+    flip = np.random.randint(2, size=num_imgs) == 0
+    augment.batch_crop_flip(images, start_y, start_x, self.inner_size, flip, target)
+
+  def _decode_into(self, names, images, rows):
+    if self.decode_pool is None:
+      for row, filename in zip(rows, names):
+        images[row] = decoder.load_image(filename, self.img_size, self.resize_cache_dir)
+    else:
+      slot = self.decode_pool.decode(names)
+      try:
+        images[rows] = self.decode_pool.slots[slot][:len(names)]
+      finally:
+        self.decode_pool.release(slot)
+
+  def get_state(self):
+    # the images of every batch were shuffled when the provider was built
+    state = ParallelDataProvider.get_state(self)
+    state['batches'] = self.batches
+    return state
+
+  def _check_state(self, state):
+    ParallelDataProvider._check_state(self, state)
+    if 'batches' not in state:
+      raise ValueError('The saved position has no batches')
+    if len(state['batches']) != len(self.batches):
+      raise ValueError('The saved position is over %d batches, not %d' % (len(state['batches']), len(self.batches)))
+
+  def set_state(self, state):
+    ParallelDataProvider.set_state(self, state)
+    self.batches = state['batches']
+
+  def close(self):
+    ParallelDataProvider.close(self)
+    if self.decode_pool is not None:
+      self.decode_pool.close()
+      self.decode_pool = None
+    if self.read_ahead is not None:
+      self.read_ahead.close()
+      self.read_ahead = None
 
-    epoch = self.curr_epoch
-    batchnum = self.curr_batch
-    names = self.images[self.batches[batchnum]]
+  def reset(self):
+    ParallelDataProvider.reset(self)
+    self._read_ahead_until = 0
+
+  def _advance(self):
+    batch, epoch = ParallelDataProvider._advance(self)
+    if self.read_ahead is not None:
+      # hints stop at the end of the epoch and start again with the next one
+      start = max(self._read_ahead_until, self.curr_batch_index + 1)
+      stop = min(len(self.batch_range), self.curr_batch_index + 1 + self.read_ahead_batches)
+      for i in range(start, stop):
+        self.read_ahead.schedule(self.sources[self.batches[self.batch_range[i]]])
+      self._read_ahead_until = max(stop, self._read_ahead_until)
+    return batch, epoch
+
+  def _start_epoch(self):
+    self.curr_epoch += 1
+    self._read_ahead_until = 0
+    if self.image_cache is not None:
+      util.log('Image cache: %d images, %d hits, %d misses (%.1f%% hit rate)', len(self.image_cache),
+               self.image_cache.hits, self.image_cache.misses, self.image_cache.hit_rate() * 100)
+
+  def _load_batch(self, batchnum):
+    index = self.batches[batchnum]
+    names = self.sources[index]
+    num_imgs = len(names)
+    shape = (self.get_data_dims(), num_imgs * self.data_mult)
+    cropped = None if self.batch_cache is None else self.batch_cache.get(batchnum)
+    if cropped is None:
+      cropped = self._crop_batch(index, names, shape)
+      if self.batch_cache is not None:
+        self.batch_cache.put(batchnum, cropped)
+
+    with self.timings('mean'):
+      data = self.buffers.get(shape, np.single)
+      np.subtract(cropped, self.data_mean, out=data)
+      self.buffers.put(cropped)
+
+    with self.timings('labels'):
+      labels = np.repeat(self.image_labels[index], self.data_mult)
+      labels = np.require(labels, dtype=np.single, requirements='C')
+    return data, labels
+
+  def _crop_batch(self, index, names, shape):
+    # the images of a batch are read in manifest order, front to back through
+    # every category directory or archive, but keep their shuffled columns
     num_imgs = len(names)
-    labels = np.zeros((1, num_imgs))
-    cropped = np.ndarray((self.get_data_dims(), num_imgs * self.data_mult), dtype=np.uint8)
-    # _load in parallel for training
-    st = time.time()
-    images = []
-    for idx, filename in enumerate(names):
-      jpeg = Image.open(filename)
-      if jpeg.mode != "RGB": jpeg = jpeg.convert("RGB")
-      # starts as rows * cols * rgb, tranpose to rgb * rows * cols
-      img = np.asarray(jpeg, np.uint8).transpose(2, 0, 1)
-      images.append(img)
-
-    self.__trim_borders(images, cropped)
-
-    load_time = time.time() - st
-
-    clabel = []
-    # extract label from the filename
-    for idx, filename in enumerate(names):
-      filename = os.path.basename(filename)
-      synid = filename[1:].split('_')[0]
-      label = self.batch_meta['synid_to_label'][synid]
-      labels[0, idx] = label
-
-    st = time.time()
-    cropped = cropped.astype(np.single)
-    cropped = np.require(cropped, dtype=np.single, requirements='C')
-    cropped -= self.data_mean
-
-    align_time = time.time() - st
-
-    labels = np.array(labels)
-    labels = labels.reshape(cropped.shape[1],)
-    labels = np.require(labels, dtype=np.single, requirements='C')
-
-    # util.log("Loaded %d images in %.2f seconds (%.2f _load, %.2f align)",
-    #         num_imgs, time.time() - start, load_time, align_time)
-    # self.data = {'data' : SharedArray(cropped), 'labels' : SharedArray(labels)}
-    self.data = cropped
-    self.labels = labels
-    #return cropped, labels, epoch
+    cropped = self.buffers.get(shape, np.uint8)
+    if self.decode_pool is not None and self.image_cache is None:
+      # crop straight out of the shared decode slot
+      with self.timings('decode'):
+        order = np.argsort(index, kind='mergesort')
+        slot = self.decode_pool.decode(names[order], order)
+      try:
+        with self.timings('crop'):
+          self._trim_borders(self.decode_pool.slots[slot][:num_imgs], cropped)
+      finally:
+        self.decode_pool.release(slot)
+    else:
+      images = self.buffers.get((num_imgs, 3, self.img_size, self.img_size), np.uint8)
+      with self.timings('decode'):
+        if self.image_cache is None:
+          missing = np.arange(num_imgs)
+        else:
+          missing = self.image_cache.lookup(index, images)
+        if len(missing) > 0:
+          missing = missing[np.argsort(index[missing], kind='mergesort')]
+          self._decode_into(names[missing], images, missing)
+          if self.image_cache is not None:
+            self.image_cache.insert(index[missing], images[missing])
+      with self.timings('crop'):
+        self._trim_borders(images, cropped)
+      self.buffers.put(images)
+    return cropped
 
   # Returns the dimensionality of the two data matrices returned by get_next_batch
   # idx is the index of the matrix.
@@ -315,22 +907,117 @@ class ImageNetDataProvider(ParallelDataProvider):
 
 
 class CifarDataProvider(ParallelDataProvider):
+  '''
+  With resident=True every batch file is loaded once into a single float32,
+  mean subtracted (num_samples, dims) array, optionally kept as a memmap in
+  resident_file.  Batches are then gathered from a fresh permutation of all the
+  samples every epoch instead of being read back from the batch files.
+  '''
   BATCH_REGEX = re.compile('^data_batch_(\d+)$')
-  def _get_next_batch(self):
+  def __init__(self, data_dir, batch_range=None, resident=False, resident_file=None,
+               prefetch=1, num_readers=1, fixed_batch_size=False, on_host=False,
+               shuffle_window=1):
+    ParallelDataProvider.__init__(self, data_dir, batch_range, prefetch, num_readers, fixed_batch_size, on_host,
+                                  shuffle_window)
+    self.resident = resident or resident_file is not None
+    if self.resident:
+      self._load_resident(resident_file)
+
+  def _batch_filename(self, batchnum):
+    return os.path.join(self.data_dir, 'data_batch_%d' % batchnum)
+
+  def _load_resident(self, resident_file):
+    batchnums = sorted(self.batch_range)
+    filenames = [self._batch_filename(b) for b in batchnums]
+    data_mean = self.batch_meta['data_mean']
+
+    if not (resident_file and self._reuse_resident(resident_file, batchnums, filenames)):
+      batches = [util.load(f) for f in filenames]
+      total = sum(b['data'].shape[1] for b in batches)
+      dims = batches[0]['data'].shape[0]
+      if resident_file:
+        self.resident_data = np.lib.format.open_memmap(resident_file, mode='w+', dtype=np.float32,
+                                                       shape=(total, dims))
+      else:
+        self.resident_data = np.empty((total, dims), dtype=np.float32)
+
+      labels, offset = [], 0
+      for b in batches:
+        n = b['data'].shape[1]
+        np.subtract(b['data'], data_mean, out=self.resident_data[offset:offset + n].T)
+        labels.extend(b['labels'])
+        offset += n
+      self.resident_labels = np.array(labels)
+      self.chunk_size = batches[0]['data'].shape[1]
+
+      if resident_file:
+        self.resident_data.flush()
+        # what the file was built from, checked by _reuse_resident
+        np.savez(resident_file + '.labels.npz', labels=self.resident_labels, batchnums=batchnums,
+                 data_mean=data_mean, chunk_size=self.chunk_size)
+
+    self.num_samples = self.resident_data.shape[0]
+    self.perm = np.random.permutation(self.num_samples)
+    self.batch_range = range(util.divup(self.num_samples, self.chunk_size))
+    util.log('Loaded %d cifar samples into memory', self.num_samples)
+
+  def _reuse_resident(self, resident_file, batchnums, filenames):
+    labels_file = resident_file + '.labels.npz'
+    newest = max(os.path.getmtime(f) for f in filenames + [self.meta_file])
+    if not os.path.exists(labels_file) or os.path.getmtime(labels_file) <= newest:
+      return False
+    saved = np.load(labels_file)
+    if (saved['batchnums'].tolist() != batchnums or
+        not np.array_equal(saved['data_mean'], self.batch_meta['data_mean'])):
+      util.log('%s was built from other batches, rebuilding it', resident_file)
+      return False
+    self.resident_data = np.load(resident_file, mmap_mode='r')
+    self.resident_labels = saved['labels']
+    self.chunk_size = int(saved['chunk_size'])
+    return True
+
+  def _start_epoch(self):
+    ParallelDataProvider._start_epoch(self)
+    if self.resident:
+      self.perm = np.random.permutation(self.num_samples)
+
+  def _iteration_state(self):
+    state = ParallelDataProvider._iteration_state(self)
+    if self.resident:
+      # replaced, never modified, by _start_epoch
+      state['perm'] = self.perm
+    return state
+
+  def _restore_iteration(self, state):
+    ParallelDataProvider._restore_iteration(self, state)
+    if self.resident:
+      self.perm = state['perm']
+
+  def _advance(self):
+    if not self.resident:
+      return ParallelDataProvider._advance(self)
+
     self.get_next_index()
     if self.curr_batch_index == 0:
-      random.shuffle(self.batch_range)
-      self.curr_epoch += 1
+      self._start_epoch()
     self.curr_batch = self.batch_range[self.curr_batch_index]
-    # print self.batch_range, self.curr_batch
+    start = self.curr_batch * self.chunk_size
+    return self.perm[start:start + self.chunk_size], self.curr_epoch
+
+  def _load_batch(self, batchnum):
+    if self.resident:
+      index = batchnum
+      img = self.buffers.get((self.resident_data.shape[1], len(index)), np.float32)
+      img[...] = self.resident_data[index].T
+      return img, self.resident_labels[index]
 
-    filename = os.path.join(self.data_dir, 'data_batch_%d' % self.curr_batch)
+    filename = self._batch_filename(batchnum)
 
     data = util.load(filename)
-    img = data['data'] - self.batch_meta['data_mean']
-    self.labels = np.array(data['labels'])
-    self.data = np.require(img, requirements='C', dtype=np.float32)
-    #return data, self.labels, self.curr_epoch
+    img = self.buffers.get(data['data'].shape, np.float32)
+    np.subtract(data['data'], self.batch_meta['data_mean'], out=img)
+    labels = np.array(data['labels'])
+    return img, labels
 
   def get_batch_filenames(self):
     return sorted([f for f in os.listdir(self.data_dir) if CifarDataProvider.BATCH_REGEX.match(f)], key=alphanum_key)
@@ -345,77 +1032,261 @@ class CifarDataProvider(ParallelDataProvider):
 
 
 
+class ImageNetTarDataProvider(ImageNetDataProvider):
+  '''
+  Reads imagenet straight out of the original per-category tar archives,
+  data_dir/n<synid>.tar, without unpacking them.  The offset of every JPEG
+  member is indexed once into data_dir/tars.manifest.npz (see
+  manifest.TarManifest), so an image costs one seek and one read, and the
+  label of an image is the one batches.meta['synid_to_label'] gives the synid
+  of its archive.  Takes the same arguments as ImageNetDataProvider.
+  '''
+  def _load_index(self, manifest_file):
+    return load_category_index(self.data_dir, self.batch_meta['synid_to_label'], manifest_file, TarManifest)
+
+
 class ImageNetCateGroupDataProvider(ImageNetDataProvider):
   TOTAL_CATEGORY = 1000
-  def __init__(self, data_dir, batch_range, num_group = 100, batch_size=128):
-    ImageNetDataProvider.__init__(self, data_dir, batch_range)
+  def __init__(self, data_dir, batch_range, num_group = 100, batch_size=128, num_workers=0,
+               prefetch=1, num_readers=1, cache_bytes=0, multiview=False,
+               fixed_batch_size=False, on_host=False,
+               shuffle_window=1, resize_cache_dir=None, test=False, batch_cache=False, batch_cache_dir=None,
+               read_ahead=0, read_ahead_threads=4):
+    ImageNetDataProvider.__init__(self, data_dir, batch_range, batch_size=batch_size, num_workers=num_workers,
+                                  prefetch=prefetch, num_readers=num_readers, cache_bytes=cache_bytes,
+                                  multiview=multiview, fixed_batch_size=fixed_batch_size, on_host=on_host,
+                                  shuffle_window=shuffle_window, resize_cache_dir=resize_cache_dir,
+                                  test=test, batch_cache=batch_cache, batch_cache_dir=batch_cache_dir,
+                                  read_ahead=read_ahead, read_ahead_threads=read_ahead_threads)
     self.num_group = num_group
 
-  def _get_next_batch(self):
-    ImageNetDataProvider._get_next_batch(self)
-    labels = self.labels / (ImageNetCateGroupDataProvider.TOTAL_CATEGORY / self.num_group)
+  def _load_batch(self, batchnum):
+    data, labels = ImageNetDataProvider._load_batch(self, batchnum)
+    labels = labels / (ImageNetCateGroupDataProvider.TOTAL_CATEGORY / self.num_group)
     labels = labels.astype(np.int).astype(np.float)
-    self.labels = labels
-    #return data.data, labels, data.epoch
+    return data, labels
+
+
+class ImageNetShardDataProvider(ImageNetDataProvider):
+  '''
+  Serves ImageNet batches out of the packed uint8 shards written by
+  scripts/build-imagenet-shards.py.  Shards are opened with np.memmap and every
+  batch is a contiguous run of images inside one shard, so reading a batch is a
+  single sequential read and no JPEG is decoded while training.
+
+  batch_range selects the shards to use.
+  '''
+  def __init__(self, data_dir, batch_range=None, batch_size=128, prefetch=1, num_readers=1, multiview=False,
+               fixed_batch_size=False, on_host=False,
+               shuffle_window=1, test=False):
+    ParallelDataProvider.__init__(self, data_dir, batch_range, prefetch, num_readers, fixed_batch_size, on_host,
+                                  shuffle_window)
+    self._init_geometry(batch_size, multiview, test)
+
+    self.shard_meta = util.load(os.path.join(data_dir, 'shards.meta'))
+    assert self.shard_meta['img_size'] == self.img_size
+    self.all_labels = np.load(os.path.join(data_dir, 'labels.npy'), mmap_mode='r')
+
+    self.shards = {}
+    self.batches = []
+    for shard in self.batch_range:
+      count = self.shard_meta['counts'][shard]
+      if count == 0:
+        continue
+      self.shards[shard] = np.load(os.path.join(data_dir, self.shard_meta['shards'][shard]), mmap_mode='r')
+      for chunk in np.array_split(np.arange(count), util.divup(count, batch_size)):
+        self.batches.append((shard, chunk[0], chunk[-1] + 1))
 
+    self.batch_range = range(len(self.batches))
+    util.log('Starting shard data provider with %d shards, %d batches', len(self.shards), len(self.batches))
+    np.random.shuffle(self.batch_range)
 
-class IntermediateDataProvider(ParallelDataProvider):
-  def __init__(self, data_dir, batch_range, data_name):
-    ParallelDataProvider.__init__(self, data_dir, batch_range)
-    self.data_name = data_name
+    self._load_data_mean()
+    self.decode_pool = None
+    self.image_cache = None
+    # shards are read sequentially already
+    self.read_ahead = None
 
-  def _get_next_batch(self):
-    self.get_next_index()
+  def get_batch_indexes(self):
+    meta = util.load(os.path.join(self.data_dir, 'shards.meta'))
+    return range(len(meta['shards']))
 
-    if self.curr_batch_index == 0:
-      random.shuffle(self.batch_range)
-      self.curr_epoch += 1
-    self.curr_batch = self.batch_range[self.curr_batch_index]
+  def _load_batch(self, batchnum):
+    shard, start, stop = self.batches[batchnum]
+    images = self.shards[shard][start:stop]
+    num_imgs = stop - start
+
+    shape = (self.get_data_dims(), num_imgs * self.data_mult)
+    cropped = self.buffers.get(shape, np.uint8)
+    self._trim_borders(images, cropped)
 
-    filename = os.path.join(self.data_dir + '.%s' % self.curr_batch)
+    data = self.buffers.get(shape, np.single)
+    np.subtract(cropped, self.data_mean, out=data)
+    self.buffers.put(cropped)
 
+    offset = self.shard_meta['offsets'][shard]
+    labels = np.repeat(self.all_labels[offset + start:offset + stop], self.data_mult)
+    return data, np.require(labels, dtype=np.single, requirements='C')
+
+
+class IntermediateDataProvider(ParallelDataProvider):
+  '''
+  Serves the features dumped by a trainer's DataDumper.  Dumps are .npy shards
+  (data_dir.N.<name>.npy) stored column-major as (dims, num), which are memory
+  mapped and handed out without unpickling or transposing; old pickled dumps
+  (data_dir.N) are still read.
+  '''
+  def __init__(self, data_dir, batch_range, data_name, prefetch=1, num_readers=1, fixed_batch_size=False,
+               on_host=False, shuffle_window=1):
+    ParallelDataProvider.__init__(self, data_dir, batch_range, prefetch, num_readers, fixed_batch_size, on_host,
+                                  shuffle_window)
+    self.data_name = data_name
+
+  def _load_batch(self, batchnum):
+    shard = shard_filename(self.data_dir, batchnum, self.data_name)
+    if os.path.exists(shard):
+      data = np.load(shard, mmap_mode='r')
+      labels = np.load(shard_filename(self.data_dir, batchnum, 'labels')).ravel()
+      return data, labels
+
+    filename = os.path.join(self.data_dir + '.%s' % batchnum)
     data_dic = util.load(filename)
     #data = np.concantenate([data[self.data_name] for data in data_list], axis = 1)
     #labels = np.concatenate([np.array( data['labels'].tolist() ) for data in data_list])
     data  = data_dic[self.data_name].transpose()
     labels = data_dic['labels']
-    self.labels = labels
-    data = np.require(data, requirements='C', dtype=np.float32)
-    self.data = data
-    #return data, labels, self.curr_epoch
+    out = self.buffers.get(data.shape, np.float32)
+    out[...] = data
+    return out, labels
 
 
 
+def shard_filename(target_path, index, name):
+  return '%s.%d.%s.npy' % (target_path, index, name)
+
+
 class MemoryDataProvider(ParallelDataProvider):
-  def __init__(self, data_holder, batch_range = None, data_name = 'fc'):
+  def __init__(self, data_holder, batch_range = None, data_name = 'fc', prefetch = 1, num_readers = 1,
+               fixed_batch_size = False, on_host = False, shuffle_window = 1):
     if batch_range is None:
       batch_range  = range(data_holder.get_count())
 
-    ParallelDataProvider.__init__(self, data_dir = '.', batch_range = batch_range)
+    ParallelDataProvider.__init__(self, data_dir = '.', batch_range = batch_range,
+                                  prefetch = prefetch, num_readers = num_readers,
+                                  fixed_batch_size = fixed_batch_size, on_host = on_host,
+                                  shuffle_window = shuffle_window)
     self.data_holder = data_holder
     self.data_holder.finish_push()
-    self.data_list = self.data_holder.memory_chunk
     self.data_name = data_name
 
-  def _get_next_batch(self):
-    self.get_next_index()
+  def _load_batch(self, batchnum):
+    data = self.data_holder.get_chunk(batchnum)
+    labels = data['labels']
+    out = self.buffers.get(data[self.data_name].shape[::-1], np.float32)
+    out[...] = data[self.data_name].transpose()
+    return out, labels
+
+
+
+class SyntheticDataProvider(ParallelDataProvider):
+  '''
+  Serves random batches generated once up front, to measure training speed
+  without disk or decode costs.  Batch i is drawn from a generator seeded with
+  (seed, i), so the same batch_range and seed always give the same data; give
+  the test provider another seed.  An empty batch_range means the first
+  num_batches batches.  Loading a batch sleeps for `latency` seconds to
+  simulate a slow source.  data_dir is ignored.
+  '''
+  def __init__(self, data_dir='.', batch_range=None, image_shape=(3, 32, 32), num_classes=10,
+               batch_size=128, num_batches=8, latency=0.0, seed=0, prefetch=1, num_readers=1,
+               fixed_batch_size=False, on_host=False, shuffle_window=1):
+    self.num_batches = num_batches
+    ParallelDataProvider.__init__(self, data_dir or '.', batch_range or None, prefetch, num_readers,
+                                  fixed_batch_size, on_host, shuffle_window)
+    self.synthetic_shape = tuple(image_shape)
+    self.num_classes = num_classes
+    self.latency = latency
+
+    dims = int(np.prod(self.synthetic_shape))
+    self.synthetic_batches = {}
+    for batch in self.batch_range:
+      rng = np.random.RandomState([seed, batch])
+      data = rng.standard_normal((dims, batch_size)).astype(np.float32)
+      labels = rng.randint(num_classes, size=batch_size).astype(np.float32)
+      self.synthetic_batches[batch] = (data, labels)
+    util.log('Generated %d synthetic batches of %d %s images', len(self.synthetic_batches), batch_size,
+             self.synthetic_shape)
 
-    if self.curr_batch_index == 0:
-      random.shuffle(self.batch_range)
-      self.curr_epoch += 1
-    self.curr_batch = self.batch_range[self.curr_batch_index]
+  def get_batch_indexes(self):
+    return range(self.num_batches)
 
-    data = self.data_list[self.curr_batch]
-    self.labels = data['labels']
-    self.data = np.require(data[self.data_name].transpose(), requirements='C', dtype=np.float32)
+  def _load_batch(self, batchnum):
+    if self.latency > 0:
+      time.sleep(self.latency)
+    # the buffer pool ignores arrays it does not own, so these are never recycled
+    return self.synthetic_batches[batchnum]
 
+  def get_data_dims(self, idx=0):
+    return int(np.prod(self.synthetic_shape)) if idx == 0 else 1
+
+  @property
+  def image_shape(self):
+    return self.synthetic_shape
+
+
+class SharedDataProvider(ParallelDataProvider):
+  '''
+  Reads the batches a data service (striate/dataservice.py) publishes into the
+  shared memory ring at data_dir, so several trainers on one machine share one
+  set of decode workers.  batch_range is ignored: batches and epochs come in
+  the order the service publishes them.  Batches are read in sequence by a
+  single reader thread.
+  '''
+  def __init__(self, data_dir='.', batch_range=None, prefetch=1, num_readers=1, fixed_batch_size=False,
+               on_host=False, shuffle_window=1, timeout=60.0):
+    ParallelDataProvider.__init__(self, data_dir, [0], prefetch, 1, fixed_batch_size, on_host, shuffle_window)
+    self.ring = dataservice.RingConsumer(data_dir, timeout)
+
+  def _advance(self):
+    seq, slot, num, epoch = self.ring.wait()
+    self.curr_batch = seq
+    self.curr_epoch = epoch
+    return (seq, slot, num), epoch
+
+  def _load_batch(self, batch):
+    seq, slot, num = batch
+    data = self.buffers.get((self.ring.dims, num), np.float32)
+    labels = np.empty(num, dtype=np.float32)
+    if not self.ring.read(seq, slot, num, data, labels):
+      self.buffers.put(data)
+      raise IOError('Batch %d was overwritten by the data service while being read' % seq)
+    return data, labels
+
+  def get_state(self):
+    # the data service owns the position
+    return None
+
+  def close(self):
+    ParallelDataProvider.close(self)
+    self.ring.close()
+
+  def get_data_dims(self, idx=0):
+    return self.ring.dims if idx == 0 else 1
+
+  @property
+  def image_shape(self):
+    return self.ring.meta['image_shape']
 
 
 DataProvider.register_data_provider('cifar10', CifarDataProvider)
 DataProvider.register_data_provider('imagenet', ImageNetDataProvider)
 DataProvider.register_data_provider('imagenetcategroup', ImageNetCateGroupDataProvider)
+DataProvider.register_data_provider('imagenetshard', ImageNetShardDataProvider)
+DataProvider.register_data_provider('imagenettar', ImageNetTarDataProvider)
 DataProvider.register_data_provider('intermediate', IntermediateDataProvider)
 DataProvider.register_data_provider('memory', MemoryDataProvider)
+DataProvider.register_data_provider('synthetic', SyntheticDataProvider)
+DataProvider.register_data_provider('shared', SharedDataProvider)
 
 
 if __name__ == "__main__":
@@ -433,4 +1304,4 @@ if __name__ == "__main__":
     if data.shape[1] != batch_size:
       break
   data = np.concatenate(data_list, axis = 1)
-  print_matrix(data, 'data')
+  util.print_matrix(data, 'data')
@@ -0,0 +1,234 @@
+'''
+A local data service: one process loads batches with any registered data
+provider and publishes them into a ring of shared memory slots, and trainer
+processes on the same machine read them through the 'shared' data provider.
+Every batch is decoded once, however many trainers use it.
+
+  python striate/dataservice.py --data_provider imagenet --data_dir /ssd/nn-data/imagenet/ \
+      --range 0-1200 --ring_dir /dev/shm/striate-imagenet-train
+  python striate/trainer.py --data_provider shared --data_dir /dev/shm/striate-imagenet-train ...
+
+The ring directory holds
+  ring.meta    pickled geometry (dims, max_cols, num_slots, max_consumers, the
+               image_shape of the provider), consumer_timeout and the service pid
+  data.npy     float32 (num_slots, dims, max_cols), the batch of every slot
+  labels.npy   float32 (num_slots, max_cols)
+  control.npy  int64 (num_slots, 3), the sequence number, size and epoch of the batch
+               of every slot; the sequence number is -1 while the slot is written
+  cursors.npy  float64 (max_consumers, 2), the last sequence number read by every
+               consumer (-1 for a free entry) and when it last showed up
+
+Batch seq goes to slot seq % num_slots.  The service only overwrites a slot
+once every live consumer has read the batch in it; consumers that have not
+shown up for consumer_timeout seconds are considered gone, and skip ahead to
+the oldest batch still in the ring when they come back.  Their cursor entries
+go to the next consumers that attach.
+'''
+
+from numpy.lib.format import open_memmap
+from striate import util
+import argparse
+import atexit
+import cPickle
+import fcntl
+import numpy as np
+import os
+import shutil
+import signal
+import sys
+import time
+
+RING_META = 'ring.meta'
+POLL_INTERVAL = 0.001
+
+
+def load_ring_meta(ring_dir, timeout = 60.0):
+  '''
+  Wait for a data service to start publishing into ring_dir and return its
+  ring.meta.
+  '''
+  meta_file = os.path.join(ring_dir, RING_META)
+  start = time.time()
+  while not os.path.exists(meta_file):
+    if time.time() - start > timeout:
+      raise IOError('No data service is publishing into %s' % ring_dir)
+    time.sleep(0.1)
+  return util.load(meta_file)
+
+
+class DataService(object):
+  def __init__(self, provider, ring_dir, num_slots = 8, max_consumers = 8, consumer_timeout = 60.0):
+    self.provider = provider
+    self.ring_dir = ring_dir
+    self.num_slots = num_slots
+    self.max_consumers = max_consumers
+    self.consumer_timeout = consumer_timeout
+    self.data = None
+
+  def _create_ring(self, dims, max_cols):
+    if os.path.exists(self.ring_dir):
+      shutil.rmtree(self.ring_dir)
+    os.makedirs(self.ring_dir)
+    path = lambda name: os.path.join(self.ring_dir, name)
+    self.data = open_memmap(path('data.npy'), 'w+', np.float32, (self.num_slots, dims, max_cols))
+    self.labels = open_memmap(path('labels.npy'), 'w+', np.float32, (self.num_slots, max_cols))
+    self.control = open_memmap(path('control.npy'), 'w+', np.int64, (self.num_slots, 3))
+    self.control[:, 0] = -1
+    self.cursors = open_memmap(path('cursors.npy'), 'w+', np.float64, (self.max_consumers, 2))
+    self.cursors[:, 0] = -1
+
+    # consumers attach once the meta file exists
+    meta = {'dims': dims, 'max_cols': max_cols, 'num_slots': self.num_slots,
+            'max_consumers': self.max_consumers, 'consumer_timeout': self.consumer_timeout,
+            'pid': os.getpid(),
+            'image_shape': getattr(self.provider, 'image_shape', None)}
+    with open(path(RING_META) + '.tmp', 'wb') as f:
+      cPickle.dump(meta, f, protocol = -1)
+    os.rename(path(RING_META) + '.tmp', path(RING_META))
+    util.log('Publishing %d slots of (%d, %d) batches in %s', self.num_slots, dims, max_cols, self.ring_dir)
+
+  def _wait_for_consumers(self, seq):
+    # the slot of seq holds seq - num_slots, which every live consumer must have read
+    while 1:
+      cursors = self.cursors[:, 0]
+      live = (cursors >= 0) & (time.time() - self.cursors[:, 1] < self.consumer_timeout)
+      if not live.any() or cursors[live].min() >= seq - self.num_slots:
+        return
+      time.sleep(POLL_INTERVAL)
+
+  def publish(self, seq, data, labels, epoch):
+    num = data.shape[1]
+    assert num <= self.data.shape[2], 'Batches must not be larger than the first one'
+    slot = seq % self.num_slots
+    self._wait_for_consumers(seq)
+    self.control[slot, 0] = -1
+    self.data[slot, :, :num] = data
+    self.labels[slot, :num] = np.asarray(labels).ravel()
+    self.control[slot, 1:] = (num, epoch)
+    self.control[slot, 0] = seq
+
+  def run(self, num_batches = None):
+    for seq, (data, labels, epoch) in enumerate(self.provider.iter_batches(num_batches)):
+      if self.data is None:
+        self._create_ring(data.shape[0], data.shape[1])
+      self.publish(seq, data, labels, epoch)
+      self.provider.buffers.put(data)
+
+  def close(self):
+    self.provider.close()
+    shutil.rmtree(self.ring_dir, ignore_errors = True)
+
+
+class RingConsumer(object):
+  '''
+  The reading end of a DataService ring, used by SharedDataProvider.
+  '''
+  def __init__(self, ring_dir, timeout = 60.0):
+    self.ring_dir = ring_dir
+    self.timeout = timeout
+    self.index = None
+    self.meta = load_ring_meta(ring_dir, timeout)
+    path = lambda name: os.path.join(ring_dir, name)
+    self.data = np.load(path('data.npy'), mmap_mode = 'r')
+    self.labels = np.load(path('labels.npy'), mmap_mode = 'r')
+    self.control = np.load(path('control.npy'), mmap_mode = 'r')
+    self.cursors = np.load(path('cursors.npy'), mmap_mode = 'r+')
+    self.dims = self.meta['dims']
+    self.num_slots = self.meta['num_slots']
+
+    # start at the newest batch, so the service does not wait for us to catch up
+    start_seq = max(self.control[:, 0].max(), 0)
+    with open(path('cursors.lock'), 'w') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      # entries of consumers the service already gave up on are free too
+      stale = time.time() - self.cursors[:, 1] >= self.meta['consumer_timeout']
+      free = np.flatnonzero((self.cursors[:, 0] < 0) | stale)
+      if len(free) == 0:
+        raise IOError('Too many consumers attached to %s' % ring_dir)
+      self.index = free[0]
+      self.cursors[self.index] = (start_seq - 1, time.time())
+    self.next_seq = start_seq
+    atexit.register(self.close)
+    util.log('Attached to data service %s as consumer %d', ring_dir, self.index)
+
+  def _check_service(self):
+    try:
+      os.kill(self.meta['pid'], 0)
+    except OSError:
+      raise IOError('The data service of %s is gone' % self.ring_dir)
+
+  def wait(self):
+    '''
+    Wait for the next batch and return (seq, slot, num, epoch).  seq is later
+    than expected if the batches in between were already overwritten.
+    '''
+    seq = self.next_seq
+    last_check = time.time()
+    while 1:
+      published = self.control[:, 0]
+      if published.max() >= seq + self.num_slots:
+        # fell behind and got overwritten: skip to the oldest batch left
+        seq = published[published >= 0].min()
+      slot = seq % self.num_slots
+      if self.control[slot, 0] == seq:
+        num, epoch = self.control[slot, 1:]
+        self.next_seq = seq + 1
+        return seq, slot, int(num), int(epoch)
+      if time.time() - last_check > 1.0:
+        self.cursors[self.index, 1] = time.time()
+        self._check_service()
+        last_check = time.time()
+      time.sleep(POLL_INTERVAL)
+
+  def read(self, seq, slot, num, data, labels):
+    '''
+    Copy batch seq out of its slot; False if it was overwritten meanwhile.
+    '''
+    data[...] = self.data[slot, :, :num]
+    labels[...] = self.labels[slot, :num]
+    if self.control[slot, 0] != seq:
+      return False
+    self.cursors[self.index] = (seq, time.time())
+    return True
+
+  def close(self):
+    if self.index is None:
+      return
+    self.cursors[self.index, 0] = -1
+    self.index = None
+
+
+if __name__ == '__main__':
+  from striate.data import DataProvider
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--data_provider', help = 'The data provider to serve', required = True)
+  parser.add_argument('--data_dir', help = 'The directory that data stored', required = True)
+  parser.add_argument('--range', help = 'The batch range of the data provider', required = True)
+  parser.add_argument('--batch_size', help = 'The number of images per imagenet or synthetic batch, which sizes the ring slots', default = 128, type = int)
+  parser.add_argument('--ring_dir', help = 'Where to publish the batches, best under /dev/shm', required = True)
+  parser.add_argument('--num_slots', help = 'The number of batches in the ring', default = 8, type = int)
+  parser.add_argument('--max_consumers', help = 'The number of trainers that can attach', default = 8, type = int)
+  parser.add_argument('--num_workers', help = 'The number of processes decoding images for the imagenet provider', default = 0, type = int)
+  parser.add_argument('--read_ahead', help = 'The number of imagenet batches whose files are read into the page cache ahead', default = 0, type = int)
+  parser.add_argument('--prefetch', help = 'The number of batches the data provider loads ahead', default = 1, type = int)
+  parser.add_argument('--num_readers', help = 'The number of threads loading batches ahead', default = 1, type = int)
+  parser.add_argument('--test', help = 'Serve deterministic imagenet test batches', action = 'store_true')
+  args = parser.parse_args()
+
+  dp_params = {'prefetch': args.prefetch, 'num_readers': args.num_readers}
+  if args.data_provider.startswith('imagenet') or args.data_provider == 'synthetic':
+    dp_params['batch_size'] = args.batch_size
+  if args.data_provider in ['imagenet', 'imagenetcategroup', 'imagenettar']:
+    dp_params['num_workers'] = args.num_workers
+    dp_params['read_ahead'] = args.read_ahead
+  if args.data_provider.startswith('imagenet'):
+    dp_params['test'] = args.test
+  dp = DataProvider.get_by_name(args.data_provider)(args.data_dir, util.string_to_int_list(args.range), **dp_params)
+
+  service = DataService(dp, args.ring_dir, args.num_slots, args.max_consumers)
+  # remove the ring on kill too
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    service.run()
+  finally:
+    service.close()
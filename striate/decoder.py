@@ -0,0 +1,199 @@
+from PIL import Image
+from multiprocessing import sharedctypes
+import Queue
+import cStringIO
+import collections
+import ctypes
+import hashlib
+import multiprocessing
+import numpy as np
+import os
+import threading
+
+
+def read_member(archive, offset, size):
+  '''
+  A file object over a member stored uncompressed inside an archive such as a
+  tar, read with one seek and one read.
+  '''
+  with open(archive, 'rb') as f:
+    f.seek(offset)
+    return cStringIO.StringIO(f.read(size))
+
+
+def load_image(filename, img_size = None, cache_dir = None):
+  '''
+  Decode an image to a (3, rows, cols) uint8 array.  filename may also be an
+  (archive, offset, size) tuple, see read_member.
+
+  With img_size the result is img_size x img_size whatever the size on disk:
+  JPEGs are decoded at the coarsest draft scale (1/2, 1/4 or 1/8) that keeps
+  both sides at least img_size, scaled so the short side is img_size and
+  center cropped.  If cache_dir is given, images that had to be resized are
+  kept there as .npy files and reused until the source changes; images that
+  are already img_size x img_size are not cached.
+  '''
+  path = filename[0] if isinstance(filename, tuple) else filename
+  # only the header is read here
+  jpeg = Image.open(read_member(*filename) if isinstance(filename, tuple) else filename)
+  resize = img_size is not None and jpeg.size != (img_size, img_size)
+  if resize and cache_dir is not None:
+    cached = resize_cache_path(cache_dir, filename, img_size)
+    try:
+      if os.path.getmtime(cached) >= os.path.getmtime(path):
+        return np.load(cached)
+    except (IOError, OSError, ValueError):
+      pass
+
+  if resize:
+    jpeg.draft('RGB', (img_size, img_size))
+  if jpeg.mode != "RGB": jpeg = jpeg.convert("RGB")
+
+  if resize and jpeg.size != (img_size, img_size):
+    width, height = jpeg.size
+    scale = float(img_size) / min(width, height)
+    width = max(img_size, int(round(width * scale)))
+    height = max(img_size, int(round(height * scale)))
+    jpeg = jpeg.resize((width, height), Image.ANTIALIAS)
+    left = (width - img_size) / 2
+    top = (height - img_size) / 2
+    jpeg = jpeg.crop((left, top, left + img_size, top + img_size))
+
+  # starts as rows * cols * rgb, tranpose to rgb * rows * cols
+  img = np.asarray(jpeg, np.uint8).transpose(2, 0, 1)
+
+  if resize and cache_dir is not None:
+    tmp = '%s.%d.tmp' % (cached, os.getpid())
+    try:
+      with open(tmp, 'wb') as f:
+        np.save(f, img)
+      os.rename(tmp, cached)
+    except (IOError, OSError):
+      pass
+  return img
+
+
+def resize_cache_path(cache_dir, filename, img_size):
+  if isinstance(filename, tuple):
+    key = hashlib.md5('%s@%d' % (os.path.abspath(filename[0]), filename[1])).hexdigest()
+  else:
+    key = hashlib.md5(os.path.abspath(filename)).hexdigest()
+  return os.path.join(cache_dir, '%s-%d.npy' % (key, img_size))
+
+
+# state of a worker process, set up once by _init_worker when the pool forks
+_worker_slots = None
+_worker_cache_dir = None
+
+def _init_worker(buffers, shape, cache_dir):
+  global _worker_slots, _worker_cache_dir
+  _worker_slots = [np.ctypeslib.as_array(b).reshape(shape) for b in buffers]
+  _worker_cache_dir = cache_dir
+
+def _decode_task(task):
+  slot, idx, filename = task
+  img_size = _worker_slots[slot].shape[-1]
+  _worker_slots[slot][idx] = load_image(filename, img_size, _worker_cache_dir)
+
+
+class DecodePool(object):
+  '''
+  A pool of worker processes that decode the images of a batch in parallel.
+  Workers write the decoded images straight into one of `num_slots` shared
+  memory slots of shape (max_batch, 3, img_size, img_size), ready for
+  augment.batch_crop_flip.  Images of any other size are resized on the way,
+  see load_image.
+  '''
+  def __init__(self, num_workers, shape, num_slots = 1, cache_dir = None):
+    self.num_workers = num_workers
+    self.shape = shape
+    size = int(np.prod(shape))
+    self._buffers = [sharedctypes.RawArray(ctypes.c_ubyte, size) for i in range(num_slots)]
+    self.slots = [np.ctypeslib.as_array(b).reshape(shape) for b in self._buffers]
+    self._free = Queue.Queue()
+    for i in range(num_slots):
+      self._free.put(i)
+    self._pool = multiprocessing.Pool(num_workers, _init_worker, (self._buffers, shape, cache_dir))
+
+  def decode(self, filenames, rows = None):
+    '''
+    Decode `filenames`, in that order, into a free slot and return the slot
+    id.  Image i goes to row rows[i] of the slot, row i by default; the caller
+    must hand the slot back with release().
+    '''
+    assert len(filenames) <= self.shape[0]
+    if rows is None:
+      rows = range(len(filenames))
+    slot = self._free.get()
+    tasks = [(slot, rows[i], filenames[i]) for i in range(len(filenames))]
+    try:
+      chunksize = max(1, len(tasks) / (self.num_workers * 4))
+      self._pool.map(_decode_task, tasks, chunksize)
+    except:
+      self.release(slot)
+      raise
+    return slot
+
+  def release(self, slot):
+    self._free.put(slot)
+
+  def close(self):
+    self._pool.terminate()
+    self._pool.join()
+
+
+class ImageCache(object):
+  '''
+  An LRU cache of decoded images keyed by image index.  At most `max_bytes`
+  worth of images of shape `img_shape` are kept in a preallocated arena, for
+  the threads of one process.
+  '''
+  def __init__(self, max_bytes, img_shape):
+    self.img_shape = tuple(img_shape)
+    self.capacity = int(max_bytes // np.prod(img_shape))
+    self.arena = np.empty((self.capacity,) + self.img_shape, dtype=np.uint8)
+
+    self._slots = collections.OrderedDict()
+    self._free = range(self.capacity)
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def lookup(self, keys, images):
+    '''
+    Copy the cached images of `keys` into the matching rows of `images` and
+    return the positions of the keys that missed.
+    '''
+    missing = []
+    with self._lock:
+      for i, key in enumerate(keys):
+        slot = self._slots.pop(key, None)
+        if slot is None:
+          missing.append(i)
+          continue
+        self._slots[key] = slot
+        images[i] = self.arena[slot]
+      self.hits += len(keys) - len(missing)
+      self.misses += len(missing)
+    return np.array(missing, dtype=np.int)
+
+  def insert(self, keys, images):
+    if self.capacity == 0:
+      return
+    with self._lock:
+      for key, img in zip(keys, images):
+        if key in self._slots:
+          continue
+        if self._free:
+          slot = self._free.pop()
+        else:
+          _, slot = self._slots.popitem(last=False)
+        self.arena[slot] = img
+        self._slots[key] = slot
+
+  def __len__(self):
+    return len(self._slots)
+
+  def hit_rate(self):
+    total = self.hits + self.misses
+    return float(self.hits) / total if total else 0.0
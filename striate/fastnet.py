@@ -197,12 +197,12 @@ class FastNet(object):
         self.grads.append(gpuarray.zeros(self.inputShapes[-2], dtype=np.float32))
 
     if not isinstance(data, GPUArray):
-      self.data = gpuarray.to_gpu(data).astype(np.float32)
+      self.data = to_gpu_float(data)
     else:
       self.data = data
 
     if not isinstance(label, GPUArray):
-      self.label = gpuarray.to_gpu(label).astype(np.float32)
+      self.label = to_gpu_float(label)
     else:
       self.label = label
 
@@ -229,6 +229,21 @@ class FastNet(object):
       self.bprop(self.data, self.label, self.output)
       self.update()
 
+  def test_multiview(self, data, label, num_views):
+    '''
+    Score a batch in which every image owns num_views consecutive columns with
+    a single forward pass, averaging the softmax output over the views.
+    '''
+    self.prepare_for_train(data, label)
+    self.fprop(self.data, self.output, TEST)
+    num_imgs = self.batchSize / num_views
+    probs = self.output.get().reshape((-1, num_imgs, num_views)).mean(axis=2)
+    labels = self.label.get().reshape((num_imgs, num_views))[:, 0].astype(np.int)
+
+    self.numCase += num_imgs - self.batchSize
+    self.cost += -np.log(probs[labels, np.arange(num_imgs)]).sum()
+    self.correct += (probs.argmax(axis=0) == labels).sum()
+
   def get_dumped_layers(self):
     layers = []
     for l in self.layers:
@@ -597,6 +612,18 @@ class DistFastNet(FastNet):
 
 
 
+def to_gpu_float(array):
+  '''
+  Upload a host array as a C-ordered float32 GPUArray.  Column views of
+  batch-major storage (the minibatches of a provider with on_host=True) are
+  uploaded as they are and transposed on the GPU.
+  '''
+  if array.dtype != np.float32:
+    array = array.astype(np.float32)
+  if array.ndim == 2 and not array.flags.c_contiguous and array.T.flags.c_contiguous:
+    return transpose(gpuarray.to_gpu(array.T))
+  return gpuarray.to_gpu(np.require(array, requirements='C'))
+
 def make_area(shape):
   assert len(shape) == 4
   channel, height, width, batch_size = shape
@@ -0,0 +1,264 @@
+from os.path import join
+from striate import util
+import numpy as np
+import os
+import tarfile
+
+MANIFEST_FILE = 'images.manifest.npz'
+TAR_MANIFEST_FILE = 'tars.manifest.npz'
+
+
+class ImageManifest(object):
+  '''
+  The list of images under an imagenet data directory (data_dir/n<synid>/*.jpg)
+  with their integer labels, their index inside their category directory and
+  their size in bytes, stored as flat numpy arrays.
+
+  The manifest remembers the category directories with their mtimes and labels;
+  it is stale as soon as one of them is added, removed or changed.
+  '''
+  FILENAME = MANIFEST_FILE
+
+  def __init__(self, data_dir, paths, labels, cat_index, sizes, dirs, dir_labels, dir_mtimes):
+    self.data_dir = data_dir
+    self.paths = paths
+    self.labels = labels
+    self.cat_index = cat_index
+    self.sizes = sizes
+    self.dirs = dirs
+    self.dir_labels = dir_labels
+    self.dir_mtimes = dir_mtimes
+
+  def __len__(self):
+    return len(self.paths)
+
+  @staticmethod
+  def build(data_dir, synid_to_label):
+    dirs = ImageManifest.category_dirs(data_dir)
+    dir_labels = ImageManifest.dir_labels_of(dirs, synid_to_label)
+    paths, labels, cat_index, sizes = [], [], [], []
+    for d, label in zip(dirs, dir_labels):
+      imgs = sorted(f for f in os.listdir(join(data_dir, d)) if f.lower().endswith(('.jpg', '.jpeg')))
+      for i, f in enumerate(imgs):
+        paths.append(join(d, f))
+        sizes.append(os.path.getsize(join(data_dir, d, f)))
+        cat_index.append(i)
+      labels.extend([label] * len(imgs))
+
+    return ImageManifest(data_dir,
+                         np.array(paths, dtype=str),
+                         np.array(labels, dtype=np.int32),
+                         np.array(cat_index, dtype=np.int32),
+                         np.array(sizes, dtype=np.int64),
+                         np.array(dirs, dtype=str),
+                         dir_labels,
+                         ImageManifest.dir_mtimes_of(data_dir, dirs))
+
+  @staticmethod
+  def category_dirs(data_dir):
+    return sorted(d for d in os.listdir(data_dir)
+                  if d.startswith('n') and os.path.isdir(join(data_dir, d)))
+
+  @staticmethod
+  def dir_labels_of(dirs, synid_to_label):
+    return np.array([synid_to_label.get(d[1:], -1) for d in dirs], dtype=np.int32)
+
+  @staticmethod
+  def dir_mtimes_of(data_dir, dirs):
+    mtimes = [os.path.getmtime(join(data_dir, d)) for d in dirs]
+    return np.array(mtimes, dtype=np.float64)
+
+  @staticmethod
+  def load(data_dir, filename):
+    arrays = np.load(filename)
+    return ImageManifest(data_dir, arrays['paths'], arrays['labels'], arrays['cat_index'],
+                         arrays['sizes'], arrays['dirs'], arrays['dir_labels'], arrays['dir_mtimes'])
+
+  def save(self, filename):
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+      np.savez(f, paths=self.paths, labels=self.labels, cat_index=self.cat_index,
+               sizes=self.sizes, dirs=self.dirs, dir_labels=self.dir_labels,
+               dir_mtimes=self.dir_mtimes)
+    os.rename(tmp, filename)
+
+  def is_valid(self, synid_to_label):
+    try:
+      if self.category_dirs(self.data_dir) != list(self.dirs):
+        return False
+      mtimes = self.dir_mtimes_of(self.data_dir, self.dirs)
+    except OSError:
+      return False
+    return (np.array_equal(mtimes, self.dir_mtimes) and
+            np.array_equal(self.dir_labels_of(self.dirs, synid_to_label), self.dir_labels))
+
+  def full_paths(self, index=None):
+    paths = self.paths if index is None else self.paths[index]
+    return np.char.add(os.path.join(self.data_dir, ''), paths)
+
+  def sources(self, index=None):
+    '''
+    What decoder.load_image reads the images from.
+    '''
+    return self.full_paths(index)
+
+
+class TarManifest(ImageManifest):
+  '''
+  The images inside the per-category tar archives of an imagenet data
+  directory (data_dir/n<synid>.tar), in archive order.  `dirs` are the
+  archives, and the byte offset of every member is kept in `offsets`, so an
+  image is read with one seek and one read without unpacking anything.
+  '''
+  FILENAME = TAR_MANIFEST_FILE
+
+  def __init__(self, data_dir, paths, labels, cat_index, sizes, dirs, dir_labels, dir_mtimes, shards, offsets):
+    ImageManifest.__init__(self, data_dir, paths, labels, cat_index, sizes, dirs, dir_labels, dir_mtimes)
+    self.shards = shards
+    self.offsets = offsets
+
+  @staticmethod
+  def build(data_dir, synid_to_label):
+    tars = TarManifest.category_dirs(data_dir)
+    tar_labels = TarManifest.dir_labels_of(tars, synid_to_label)
+    paths, labels, cat_index, sizes, shards, offsets = [], [], [], [], [], []
+    for shard, (t, label) in enumerate(zip(tars, tar_labels)):
+      archive = tarfile.open(join(data_dir, t))
+      try:
+        members = [m for m in archive.getmembers() if m.isfile() and m.name.lower().endswith(('.jpg', '.jpeg'))]
+      finally:
+        archive.close()
+      for i, m in enumerate(members):
+        paths.append(m.name)
+        sizes.append(m.size)
+        offsets.append(m.offset_data)
+        cat_index.append(i)
+      labels.extend([label] * len(members))
+      shards.extend([shard] * len(members))
+
+    return TarManifest(data_dir,
+                       np.array(paths, dtype=str),
+                       np.array(labels, dtype=np.int32),
+                       np.array(cat_index, dtype=np.int32),
+                       np.array(sizes, dtype=np.int64),
+                       np.array(tars, dtype=str),
+                       tar_labels,
+                       TarManifest.dir_mtimes_of(data_dir, tars),
+                       np.array(shards, dtype=np.int32),
+                       np.array(offsets, dtype=np.int64))
+
+  @staticmethod
+  def category_dirs(data_dir):
+    return sorted(f for f in os.listdir(data_dir)
+                  if f.startswith('n') and f.endswith('.tar') and os.path.isfile(join(data_dir, f)))
+
+  @staticmethod
+  def dir_labels_of(tars, synid_to_label):
+    return np.array([synid_to_label.get(t[1:-len('.tar')], -1) for t in tars], dtype=np.int32)
+
+  @staticmethod
+  def load(data_dir, filename):
+    arrays = np.load(filename)
+    return TarManifest(data_dir, arrays['paths'], arrays['labels'], arrays['cat_index'],
+                       arrays['sizes'], arrays['dirs'], arrays['dir_labels'], arrays['dir_mtimes'],
+                       arrays['shards'], arrays['offsets'])
+
+  def save(self, filename):
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+      np.savez(f, paths=self.paths, labels=self.labels, cat_index=self.cat_index,
+               sizes=self.sizes, dirs=self.dirs, dir_labels=self.dir_labels,
+               dir_mtimes=self.dir_mtimes, shards=self.shards, offsets=self.offsets)
+    os.rename(tmp, filename)
+
+  def full_paths(self, index=None):
+    # archive/member, for logs and signatures
+    index = np.arange(len(self)) if index is None else index
+    archives = np.char.add(np.char.add(os.path.join(self.data_dir, ''), self.dirs[self.shards[index]]), '/')
+    return np.char.add(archives, self.paths[index])
+
+  def sources(self, index=None):
+    '''
+    (archive, offset, size) of every image, see decoder.load_image.
+    '''
+    index = np.arange(len(self)) if index is None else index
+    archives = self.dirs[self.shards[index]]
+    sources = np.empty(len(index), dtype=object)
+    for i, (archive, offset, size) in enumerate(zip(archives, self.offsets[index], self.sizes[index])):
+      sources[i] = (join(self.data_dir, archive), int(offset), int(size))
+    return sources
+
+
+def load_manifest(data_dir, synid_to_label, filename=None, manifest_class=ImageManifest):
+  '''
+  Load the manifest of data_dir, rebuilding (and saving) it when it is missing
+  or stale.
+  '''
+  if filename is None:
+    filename = os.path.join(data_dir, manifest_class.FILENAME)
+
+  if os.path.exists(filename):
+    manifest = manifest_class.load(data_dir, filename)
+    if manifest.is_valid(synid_to_label):
+      return manifest
+    util.log('Manifest %s is stale, rebuilding', filename)
+
+  util.log('Building image manifest for %s', data_dir)
+  manifest = manifest_class.build(data_dir, synid_to_label)
+  try:
+    manifest.save(filename)
+    util.log('Wrote manifest of %d images to %s', len(manifest), filename)
+  except (IOError, OSError):
+    util.log('Could not write manifest %s', filename, exc_info=True)
+  return manifest
+
+
+class CategoryIndex(object):
+  '''
+  The images of a manifest grouped by label, CSR style: the images of label l
+  are order[offsets[l + 1]:offsets[l + 2]] in manifest order, and those
+  without a label (-1) come first and are never selected.  Selecting the images
+  of some categories costs O(selected images).
+  '''
+  def __init__(self, manifest):
+    self.manifest = manifest
+    self.order = np.argsort(manifest.labels, kind='mergesort')
+    counts = np.bincount(manifest.labels + 1)
+    self.offsets = np.concatenate([[0], np.cumsum(counts)])
+    if self.offsets[1] > 0:
+      util.log('Skipping %d images whose synid is not in synid_to_label', self.offsets[1])
+
+  def images_of(self, label):
+    if label + 2 >= len(self.offsets):
+      return self.order[:0]
+    return self.order[self.offsets[label + 1]:self.offsets[label + 2]]
+
+  def select(self, cat_range, category_range=None):
+    '''
+    Indexes, in manifest order, of the images whose index inside their category
+    is in cat_range and whose label is in category_range (any label if None).
+    '''
+    if category_range is None:
+      selected = self.order[self.offsets[1]:]
+    else:
+      selected = np.concatenate([self.order[:0]] + [self.images_of(l) for l in category_range])
+    selected = selected[np.in1d(self.manifest.cat_index[selected], cat_range)]
+    selected.sort()
+    return selected
+
+
+# category indexes already loaded by this process, by data_dir and manifest
+_index_cache = {}
+
+def load_category_index(data_dir, synid_to_label, filename=None, manifest_class=ImageManifest):
+  '''
+  The CategoryIndex of data_dir.  It is kept for the life of the process and
+  shared by every provider over the same data_dir, as long as its manifest
+  stays valid.
+  '''
+  key = (os.path.abspath(data_dir), filename, manifest_class)
+  index = _index_cache.get(key)
+  if index is None or not index.manifest.is_valid(synid_to_label):
+    index = CategoryIndex(load_manifest(data_dir, synid_to_label, filename, manifest_class))
+    _index_cache[key] = index
+  return index
@@ -0,0 +1,134 @@
+'''
+Read-ahead for the images of upcoming batches.
+
+Batches are shuffled, so their images are opened in random order, which is
+the worst pattern for spinning disks and network filesystems.  ReadAhead takes
+the image lists of the batches after the ones being loaded and, from a few
+threads, asks the kernel to read them into the page cache (posix_fadvise
+WILLNEED), visiting the files of every batch in inode and offset order.  By
+the time a reader or decode worker opens an image its bytes are in memory.
+Where posix_fadvise is missing the bytes are read and dropped instead, which
+warms the page cache the same way.
+
+The page cache is also what hands the bytes to the decode stage: decode
+workers are separate processes and read the images themselves.
+'''
+
+import Queue
+import ctypes
+import ctypes.util
+import os
+import threading
+
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+READ_CHUNK = 1 << 20
+
+
+def _load_fadvise():
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fadvise = libc.posix_fadvise
+  except (OSError, AttributeError):
+    return None
+  fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+  fadvise.restype = ctypes.c_int
+  return fadvise
+
+_fadvise = _load_fadvise()
+
+
+def _region(source):
+  # (path, offset, length) of an image; length 0 is the whole file
+  if isinstance(source, tuple):
+    return source
+  return source, 0, 0
+
+
+def advise(source, advice, sync=False):
+  '''
+  posix_fadvise the bytes of an image, a filename or an (archive, offset,
+  size) tuple.  False if posix_fadvise is not available.
+  '''
+  if _fadvise is None:
+    return False
+  path, offset, length = _region(source)
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    if sync:
+      os.fdatasync(fd)
+    _fadvise(fd, offset, length, advice)
+  finally:
+    os.close(fd)
+  return True
+
+
+def evict(sources):
+  '''
+  Drop the images from the page cache, to measure reads from a cold disk.
+  Dirty pages cannot be dropped, so the files are synced first.
+  '''
+  for source in sources:
+    advise(source, POSIX_FADV_DONTNEED, sync=True)
+
+
+def read_through(source):
+  path, offset, length = _region(source)
+  with open(path, 'rb') as f:
+    f.seek(offset)
+    remaining = length or os.fstat(f.fileno()).st_size - offset
+    while remaining > 0:
+      chunk = f.read(min(remaining, READ_CHUNK))
+      if not chunk:
+        break
+      remaining -= len(chunk)
+
+
+class ReadAhead(object):
+  '''
+  Warms the page cache with the images of scheduled batches, one batch at a
+  time per thread.  schedule() only queues the batch, so it is cheap enough to
+  call from the provider's _advance.
+  '''
+  def __init__(self, num_threads=4, use_fadvise=True):
+    self.use_fadvise = use_fadvise and _fadvise is not None
+    self._inodes = {}
+    self._queue = Queue.Queue()
+    self._threads = []
+    for i in range(num_threads):
+      thread = threading.Thread(target=self._run)
+      thread.setDaemon(True)
+      thread.start()
+      self._threads.append(thread)
+
+  def _disk_order(self, source):
+    path, offset, _ = _region(source)
+    inode = self._inodes.get(path)
+    if inode is None:
+      try:
+        inode = self._inodes[path] = os.stat(path).st_ino
+      except OSError:
+        inode = 0
+    return inode, offset
+
+  def _run(self):
+    while 1:
+      sources = self._queue.get()
+      if sources is None:
+        return
+      for source in sorted(sources, key=self._disk_order):
+        try:
+          if self.use_fadvise:
+            advise(source, POSIX_FADV_WILLNEED)
+          else:
+            read_through(source)
+        except (IOError, OSError):
+          # the reader reports unreadable images
+          pass
+
+  def schedule(self, sources):
+    self._queue.put(list(sources))
+
+  def close(self):
+    for thread in self._threads:
+      self._queue.put(None)
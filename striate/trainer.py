@@ -1,56 +1,165 @@
 from pycuda import gpuarray, driver
-from striate import util, layer
+from striate import dataservice, util, layer
 from striate.fastnet import FastNet, AdaptiveFastNet
 from striate.layer import TRAIN, TEST
 from striate.parser import parse_config_file
 from striate.scheduler import Scheduler
 from striate.util import divup, timer, load
-from data import DataProvider, ImageNetDataProvider
+from data import DataProvider, ImageNetDataProvider, shard_filename
+import Queue
 import argparse
+import atexit
 import cPickle
+import collections
 import glob
 import numpy as np
 import os
 import pprint
 import re
+import shutil
+import struct
 import sys
+import tempfile
+import threading
 import time
 
+NPY_HEADER_SIZE = 128
+
+def npy_header(dtype, shape):
+  '''
+  A Fortran-ordered .npy header padded to NPY_HEADER_SIZE bytes, so it can be
+  rewritten in place once the final shape is known.
+  '''
+  header = "{'descr': %r, 'fortran_order': True, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), shape)
+  header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+  return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header
+
+
+class NpyAppender(object):
+  '''
+  Appends rows of a (num, dims) array to a .npy file, where it is stored as a
+  (dims, num) Fortran-ordered array.  The file is written under a temporary
+  name and renamed by close().
+  '''
+  def __init__(self, filename, dims, dtype):
+    self.filename = filename
+    self.dims = dims
+    self.dtype = np.dtype(dtype)
+    self.num = 0
+    self.f = open(filename + '.tmp', 'wb')
+    self.f.write(npy_header(self.dtype, (self.dims, 0)))
+
+  def append(self, rows):
+    rows = np.require(rows.reshape((rows.shape[0], -1)), dtype=self.dtype, requirements='C')
+    assert rows.shape[1] == self.dims
+    rows.tofile(self.f)
+    self.num += rows.shape[0]
+
+  def close(self):
+    self.f.seek(0)
+    self.f.write(npy_header(self.dtype, (self.dims, self.num)))
+    self.f.close()
+    os.rename(self.filename + '.tmp', self.filename)
+
+
 class DataDumper(object):
-  def __init__(self, target_path, max_mem_size = 500e5):
+  '''
+  Writes dicts of per-sample arrays (samples along axis 0) to one .npy shard per
+  key, target_path.N.<key>.npy, stored column-major as (dims, num) so
+  IntermediateDataProvider can memory map them.
+
+  add() only queues the arrays; a writer thread appends them to the current
+  shards and starts new ones every max_mem_size elements.  At most max_queue
+  batches wait in memory.  close() writes out the rest and stops the thread.
+  '''
+  # queued by close() to stop the writer thread
+  _STOP = object()
+
+  def __init__(self, target_path, max_mem_size = 500e5, max_queue = 8):
     self.target_path = target_path
-    self.data = []
     self.sz = 0
     self.count = 0
     self.max_mem_size = max_mem_size
+    self._files = {}
+    self._error = None
+    self._queue = Queue.Queue(max_queue)
+    self._writer = threading.Thread(target = self._run)
+    self._writer.setDaemon(True)
+    self._writer.start()
 
     util.log('dumper establised')
     util.log('target path:    %s', self.target_path)
     util.log('max_memory:     %s', self.max_mem_size)
 
-  def add(self, data):
-    for k, v in data.iteritems():
-      self.sz += np.prod(v.shape)
-    self.data.append(data)
+  def _check_error(self):
+    if self._error is not None:
+      exc_info, self._error = self._error, None
+      raise exc_info[0], exc_info[1], exc_info[2]
 
-    if self.sz > self.max_mem_size:
-      self.flush()
+  def add(self, data):
+    self._check_error()
+    if self._writer is None:
+      raise ValueError('DataDumper for %s is closed' % self.target_path)
+    self._queue.put(data)
 
   def flush(self):
-    if self.sz == 0:
+    '''
+    Wait until everything added so far is written and close the current shards.
+    '''
+    self._queue.put(None)
+    self._queue.join()
+    self._check_error()
+
+  def close(self):
+    '''
+    Write out everything added so far and stop the writer thread.
+    '''
+    if self._writer is None:
       return
+    self._queue.put(None)
+    self._queue.put(DataDumper._STOP)
+    self._writer.join()
+    self._writer = None
+    self._check_error()
+
+  def _run(self):
+    while 1:
+      data = self._queue.get()
+      if data is DataDumper._STOP:
+        self._queue.task_done()
+        return
+      try:
+        if self._error is None:
+          if data is None:
+            self._close_shard()
+          else:
+            self._write(data)
+      except Exception:
+        util.log('Failed to write layer dump to %s', self.target_path, exc_info=True)
+        self._error = sys.exc_info()
+      finally:
+        self._queue.task_done()
+
+  def _write(self, data):
+    if not self._files:
+      for k, v in data.iteritems():
+        filename = shard_filename(self.target_path, self.count, k)
+        self._files[k] = NpyAppender(filename, int(np.prod(v.shape[1:])), v.dtype)
 
-    out = {}
-    for k in self.data[0].keys():
-      items = [d[k] for d in self.data]
-      out[k] = np.concatenate(items, axis=0)
+    for k, v in data.iteritems():
+      self._files[k].append(v)
+      self.sz += v.size
 
-    filename = '%s.%d' % (self.target_path, self.count)
-    with open(filename, 'w') as f:
-      cPickle.dump(out, f, -1)
+    if self.sz > self.max_mem_size:
+      self._close_shard()
 
-    util.log('Wrote layer dump to %s', filename)
-    self.data = []
+  def _close_shard(self):
+    if not self._files:
+      return
+    for f in self._files.values():
+      f.close()
+    util.log('Wrote layer dump %d to %s', self.count, self.target_path)
+    self._files = {}
     self.sz = 0
     self.count += 1
 
@@ -61,14 +170,30 @@ class DataDumper(object):
 
 
 class MemoryDataHolder(object):
-  def __init__(self, single_memory_size = 50e6, total_memory_size = 2e9):
+  '''
+  Keeps captured data in chunks of about single_memory_size bytes.  Chunks stay
+  in memory up to total_memory_size bytes; past that the least recently used
+  ones, by flush() or get_chunk(), are spilled to .npy files under spill_dir
+  and read back through memmaps, so nothing is dropped.  Spilled chunks are not
+  promoted back to memory when read: providers scan the chunks in a cycle,
+  which would make every read evict the chunk needed next.  A spill_dir the
+  holder created itself is removed by close(), or at exit.
+  '''
+  def __init__(self, single_memory_size = 50e6, total_memory_size = 2e9, spill_dir = None):
     self.single_memory_size = single_memory_size
     self.total_memory_size = total_memory_size
     self.single_data_size = 0
     self.total_data_size = 0
     self.count = 0
     self.data = []
-    self.memory_chunk = []
+    # chunk index -> dict of arrays, least recently used first; get_chunk
+    # moves the chunk it returns to the end
+    self.memory_chunk = collections.OrderedDict()
+    # chunk index -> dict of .npy filenames
+    self.spilled_chunk = {}
+    self.spill_dir = spill_dir
+    self._own_spill_dir = False
+    self._lock = threading.Lock()
 
     util.log('memory data holder establised')
     util.log('total memory size:    %s', self.total_memory_size)
@@ -82,7 +207,7 @@ class MemoryDataHolder(object):
     self.data.append(data)
 
     if self.total_data_size > self.total_memory_size:
-      self.cut_off_chunk()
+      self.spill_chunks()
 
     if self.single_data_size > self.single_memory_size:
       self.flush()
@@ -97,7 +222,8 @@ class MemoryDataHolder(object):
       items= [d[k] for d in self.data]
       dic[k] = np.concatenate(items, axis = 0)
 
-    self.memory_chunk.append(dic)
+    with self._lock:
+      self.memory_chunk[self.count] = dic
 
     util.log('add another memory chunk')
     util.log('memory chunk size:    %s', self.single_data_size)
@@ -107,20 +233,39 @@ class MemoryDataHolder(object):
     self.single_data_size = 0
     self.count += 1
 
-  def cut_off_chunk(self):
-    if len(self.memory_chunk) == 0:
-      util.log('There is no chunk to cut off')
-      return
-
-    size = 0
-    for k, v, in self.memory_chunk[0].iteritems():
-      size += self.memory_chunk[0][k].nbytes
-
-    del self.memory_chunk[0]
-    self.total_data_size -= size
-    util.log('drop off the first memory chunk')
-    util.log('droped chunk size:    %s', size)
-    util.log('total data size:      %s', self.total_data_size)
+  def spill_chunks(self):
+    '''
+    Move the least recently used chunks to disk until the data held in memory
+    fits in total_memory_size.
+    '''
+    with self._lock:
+      while self.total_data_size > self.total_memory_size and self.memory_chunk:
+        index, dic = self.memory_chunk.popitem(last = False)
+        self.spilled_chunk[index] = self._spill(index, dic)
+        size = sum(v.nbytes for v in dic.itervalues())
+        self.total_data_size -= size
+        util.log('spilled memory chunk %d (%s bytes) to disk', index, size)
+        util.log('total data size:      %s', self.total_data_size)
+
+  def _spill(self, index, dic):
+    if self.spill_dir is None:
+      self.spill_dir = tempfile.mkdtemp(prefix = 'striate-holder-')
+      self._own_spill_dir = True
+      atexit.register(self.close)
+    files = {}
+    for k, v in dic.iteritems():
+      files[k] = os.path.join(self.spill_dir, 'chunk-%d.%s.npy' % (index, k))
+      np.save(files[k], v)
+    return files
+
+  def get_chunk(self, index):
+    with self._lock:
+      if index in self.memory_chunk:
+        dic = self.memory_chunk.pop(index)
+        self.memory_chunk[index] = dic
+        return dic
+      files = self.spilled_chunk[index]
+    return dict((k, np.load(f, mmap_mode = 'r')) for k, f in files.iteritems())
 
   def finish_push(self):
     self.flush()
@@ -128,6 +273,11 @@ class MemoryDataHolder(object):
   def get_count(self):
     return self.count
 
+  def close(self):
+    if self._own_spill_dir:
+      shutil.rmtree(self.spill_dir, ignore_errors = True)
+      self._own_spill_dir = False
+
 
 
 
@@ -179,6 +329,9 @@ class Trainer:
     self.batch_size = batch_size
     self.net = net
     self.curr_batch = self.curr_epoch = 0
+    # what the current providers serve, e.g. the category range of a catewise
+    # stage; a saved position only applies to providers of the same key
+    self.data_provider_key = None
 
     for k, v in kw.iteritems():
       setattr(self, k, v)
@@ -199,12 +352,37 @@ class Trainer:
       self.train_output_filename = ''
       self.test_output_filename = ''
     self.init_output_dumper()
+    # trainers that build their own providers in _finish_init restore the
+    # position once they have built the ones it was saved from
+    self._pending_dp_state = checkpoint.get('dp_state') if checkpoint else None
     self._finish_init()
+    self.restore_data_provider_state()
 
   def _finish_init(self):
     pass
 
+  def restore_data_provider_state(self):
+    '''
+    Continue the providers from the position of the checkpoint, if it was
+    saved from providers with the current data_provider_key.
+    '''
+    dp_state = self._pending_dp_state
+    if not dp_state or dp_state.get('key') != self.data_provider_key:
+      return
+    self._pending_dp_state = None
+    # the train provider goes last, so the shared random generators continue from its position
+    for name, dp in [('test', self.test_dp), ('train', self.train_dp)]:
+      state = dp_state.get(name)
+      if state is None:
+        continue
+      try:
+        dp.set_state(state)
+        util.log('Resuming the %s data provider in epoch %d', name, state['epoch'])
+      except ValueError, e:
+        util.log('Not resuming the %s data provider: %s', name, e)
+
   def init_output_dumper(self):
+    self.close_output_dumper()
     if self.train_output_filename:
       self.train_dumper = DataDumper(self.train_output_filename)
     if self.test_output_filename:
@@ -212,6 +390,23 @@ class Trainer:
     #self.train_dumper = MemoryDataHolder()
     #self.test_dumper = MemoryDataHolder()
 
+  def close_output_dumper(self):
+    for name in ['train_dumper', 'test_dumper']:
+      dumper = getattr(self, name, None)
+      if dumper is not None:
+        dumper.close()
+      setattr(self, name, None)
+
+  def close(self):
+    '''
+    Write out the captured outputs and stop the data providers.
+    '''
+    try:
+      self.close_output_dumper()
+    finally:
+      self.train_dp.close()
+      self.test_dp.close()
+
 
   def init_data_provider(self):
     self.train_dp.reset()
@@ -224,7 +419,9 @@ class Trainer:
     model['train_outputs'] = self.train_outputs
     model['test_outputs'] = self.test_outputs
 
-    dic = {'model_state': model, 'op':None}
+    dp_state = {'train': self.train_dp.get_state(), 'test': self.test_dp.get_state(),
+                'key': self.data_provider_key}
+    dic = {'model_state': model, 'op':None, 'dp_state': dp_state}
     print >> sys.stderr,  '---- save checkpoint ----'
     self.print_net_summary()
     self.checkpoint_dumper.dump(checkpoint = dic, suffix = self.curr_epoch)
@@ -236,10 +433,14 @@ class Trainer:
 
   def get_test_error(self):
     start = time.time()
-    test_data = self.test_dp.get_next_batch(self.batch_size)
+    num_views = self.test_dp.data_mult if getattr(self.test_dp, 'multiview', False) else 1
+    test_data = self.test_dp.get_next_batch(self.batch_size * num_views)
 
     input, label = test_data.data, test_data.labels
-    self.net.train_batch(input, label, TEST)
+    if num_views > 1:
+      self.net.test_multiview(input, label, num_views)
+    else:
+      self.net.train_batch(input, label, TEST)
     self._capture_test_data()
 
     cost , correct, numCase, = self.net.get_batch_information()
@@ -526,10 +727,11 @@ class ImageNetLayerwisedTrainer(Trainer):
 
       train_dp_old = self.train_dp
       test_dp_old = self.test_dp
+      key_old = self.data_provider_key
       self.init_subnet_data_provider()
-
-      self.train_dumper = None
-      self.test_dumper = None
+      self.data_provider_key = ('intermediate', i)
+      # the subnet reads the shards the dumpers wrote, and captures nothing itself
+      self.close_output_dumper()
 
       image_shape_old = self.image_shape
       shape = self.curr_model['model_state']['layers'][-3]['outputShape']
@@ -549,8 +751,11 @@ class ImageNetLayerwisedTrainer(Trainer):
       del layers[-1], layers[-1]
       layers.extend(self.net.get_dumped_layers())
 
+      self.train_dp.close()
+      self.test_dp.close()
       self.train_dp = train_dp_old
       self.test_dp = test_dp_old
+      self.data_provider_key = key_old
 
       #for layer in self.curr_model['model_state']['layers'][:-2]:
       #  layer['disableBprop'] = True
@@ -588,9 +793,14 @@ class ImageNetCatewisedTrainer(MiniBatchTrainer):
 
 
   def set_category_range(self, r):
+    # stop the readers and decode workers of the providers being replaced
+    self.train_dp.close()
+    self.test_dp.close()
     dp = DataProvider.get_by_name(self.data_provider)
-    self.train_dp = dp(self.data_dir, self.train_range, category_range = range(r))
-    self.test_dp = dp(self.data_dir, self.test_range, category_range = range(r))
+    self.train_dp = dp(self.data_dir, self.train_range, category_range = range(r), **getattr(self, 'dp_params', {}))
+    self.test_dp = dp(self.data_dir, self.test_range, category_range = range(r), **getattr(self, 'test_dp_params', {}))
+    self.data_provider_key = ('category_range', r)
+    self.restore_data_provider_state()
 
 
   def train(self):
@@ -644,9 +854,14 @@ class ImageNetCateGroupTrainer(MiniBatchTrainer):
     MiniBatchTrainer._finish_init(self)
 
   def set_num_group(self, n):
+    # stop the readers and decode workers of the providers being replaced
+    self.train_dp.close()
+    self.test_dp.close()
     dp = DataProvider.get_by_name(self.data_provider)
-    self.train_dp = dp(self.data_dir, self.train_range, n)
-    self.test_dp = dp(self.data_dir, self.test_range, n)
+    self.train_dp = dp(self.data_dir, self.train_range, n, **getattr(self, 'dp_params', {}))
+    self.test_dp = dp(self.data_dir, self.test_range, n, **getattr(self, 'test_dp_params', {}))
+    self.data_provider_key = ('num_group', n)
+    self.restore_data_provider_state()
 
 
   def train(self):
@@ -682,7 +897,7 @@ if __name__ == '__main__':
   parser.add_argument('--test_id', help = 'Test Id', default = None, type = int)
   parser.add_argument('--data_dir', help = 'The directory that data stored')
   parser.add_argument('--param_file', help = 'The param_file or checkpoint file')
-  parser.add_argument('--data_provider', help = 'The data provider', choices =['cifar10','imagenet', 'imagenetcategroup'])
+  parser.add_argument('--data_provider', help = 'The data provider', choices =['cifar10','imagenet', 'imagenetcategroup', 'imagenetshard', 'imagenettar', 'synthetic', 'shared'])
   parser.add_argument('--train_range', help = 'The range of the train set')
   parser.add_argument('--test_range', help = 'THe range of the test set')
   parser.add_argument('--save_freq', help = 'How often should I save the checkpoint file', default = 100, type = int)
@@ -698,15 +913,38 @@ if __name__ == '__main__':
 
 
   # extra argument
-  extra_argument = ['num_group_list', 'num_caterange_list', 'num_epoch', 'num_batch', 'output_dir']
+  extra_argument = ['num_group_list', 'num_caterange_list', 'num_epoch', 'num_batch', 'output_dir', 'num_workers',
+      'prefetch', 'num_readers', 'resident', 'image_cache_mb', 'multiview_test',
+      'fixed_batch_size', 'host_batches', 'shuffle_window', 'image_size', 'num_classes', 'synthetic_latency',
+      'resize_cache_dir', 'cache_test_batches', 'test_batch_cache_dir', 'test_data_dir',
+      'read_ahead']
   parser.add_argument('--num_group_list', help = 'The list of the group you want to split the data to')
   parser.add_argument('--num_caterange_list', help = 'The list of category range you want to train')
   parser.add_argument('--num_epoch', help = 'The number of epoch you want to train', default = 30, type = int)
   parser.add_argument('--num_batch', help = 'The number of minibatch you want to train(num*1000)')
   parser.add_argument('--output_dir', help = 'The directory where to dumper input for last fc layer while training', default='')
+  parser.add_argument('--num_workers', help = 'The number of processes decoding images for the imagenet provider', default = 0, type = int)
+  parser.add_argument('--prefetch', help = 'The number of batches the data provider loads ahead', default = 1, type = int)
+  parser.add_argument('--num_readers', help = 'The number of threads loading batches ahead', default = 1, type = int)
+  parser.add_argument('--image_cache_mb', help = 'How many MB of decoded imagenet images to keep in memory', default = 0, type = int)
+  parser.add_argument('--multiview_test', help = 'Test imagenet on 10 crops per image and average the predictions', action = 'store_true')
+  parser.add_argument('--fixed_batch_size', help = 'Stitch minibatches across batch files so they all have batch_size columns', action = 'store_true')
+  parser.add_argument('--host_batches', help = 'Keep batches in host memory and pass minibatch views to the net', action = 'store_true')
+  parser.add_argument('--shuffle_window', help = 'The number of batch files whose samples are shuffled together', default = 1, type = int)
+  parser.add_argument('--read_ahead', help = 'The number of imagenet batches whose files are read into the page cache ahead', default = 0, type = int)
+  parser.add_argument('--resize_cache_dir', help = 'Where to keep imagenet images resized to 256x256')
+  parser.add_argument('--cache_test_batches', help = 'Keep the preprocessed imagenet test batches in memory', action = 'store_true')
+  parser.add_argument('--test_batch_cache_dir', help = 'Keep the preprocessed imagenet test batches in this directory')
+  parser.add_argument('--image_size', help = 'The image size of the synthetic data provider, and of the shared one if its data service does not know it', default = 32, type = int)
+  parser.add_argument('--num_classes', help = 'The number of labels of the synthetic data provider', default = 10, type = int)
+  parser.add_argument('--synthetic_latency', help = 'Seconds the synthetic data provider waits per batch', default = 0.0, type = float)
+  parser.add_argument('--test_data_dir', help = 'The directory of the test set if not data_dir, e.g. the ring of a second data service')
+  parser.add_argument('--resident', help = 'Keep the whole cifar set in memory and shuffle samples every epoch', action = 'store_true')
 
   args = parser.parse_args()
 
+  if args.data_provider == 'synthetic':
+    extra_argument += ['data_dir', 'train_range', 'test_range']
   for a in [att for att in dir(args) if not att.startswith('__')]:
     if not getattr(args, a) and a not in extra_argument:
       assert False, 'You have to specify a value of %s' % a
@@ -716,11 +954,22 @@ if __name__ == '__main__':
   param_dict['image_color'] = 3
   param_dict['test_id'] = args.test_id
   param_dict['data_dir'] = args.data_dir
+  param_dict['test_data_dir'] = args.test_data_dir or args.data_dir
   param_dict['data_provider'] = args.data_provider
   if args.data_provider.startswith('imagenet'):
     param_dict['image_size'] = 224
   elif args.data_provider.startswith('cifar'):
     param_dict['image_size'] = 32
+  elif args.data_provider == 'shared':
+    # the data service decides the geometry of the batches
+    image_shape = dataservice.load_ring_meta(args.data_dir)['image_shape']
+    if image_shape is None:
+      param_dict['image_size'] = args.image_size
+    else:
+      param_dict['image_color'] = image_shape[0]
+      param_dict['image_size'] = image_shape[-1]
+  elif args.data_provider == 'synthetic':
+    param_dict['image_size'] = args.image_size
   else:
     assert False, 'Unknown data_provider %s' % args.data_provider
 
@@ -760,9 +1009,42 @@ if __name__ == '__main__':
   param_dict['init_model'] = init_model
 
   #create train dataprovider and test dataprovider
+  dp_params = {'prefetch': args.prefetch, 'num_readers': args.num_readers,
+               'fixed_batch_size': args.fixed_batch_size, 'on_host': args.host_batches,
+               'shuffle_window': args.shuffle_window}
+  if param_dict['data_provider'] in ['imagenet', 'imagenetcategroup', 'imagenettar']:
+    dp_params['num_workers'] = args.num_workers
+    dp_params['cache_bytes'] = args.image_cache_mb * 1024 * 1024
+    dp_params['resize_cache_dir'] = args.resize_cache_dir
+    dp_params['read_ahead'] = args.read_ahead
+  if param_dict['data_provider'] == 'cifar10':
+    dp_params['resident'] = args.resident
+  if param_dict['data_provider'] == 'synthetic':
+    dp_params['image_shape'] = (param_dict['image_color'], args.image_size, args.image_size)
+    dp_params['num_classes'] = args.num_classes
+    dp_params['batch_size'] = args.batch_size
+    dp_params['latency'] = args.synthetic_latency
+  test_dp_params = dict(dp_params)
+  # test batches are read in order, and multiview columns must stay together
+  test_dp_params['shuffle_window'] = 1
+  if 'cache_bytes' in test_dp_params:
+    # test images are seen once per test run; the budget goes to training
+    test_dp_params['cache_bytes'] = 0
+  if param_dict['data_provider'] == 'synthetic':
+    # other samples than the training batches
+    test_dp_params['seed'] = 1
+  if param_dict['data_provider'] in ['imagenet', 'imagenetcategroup', 'imagenetshard', 'imagenettar']:
+    test_dp_params['multiview'] = args.multiview_test
+    test_dp_params['test'] = True
+  if param_dict['data_provider'] in ['imagenet', 'imagenetcategroup', 'imagenettar']:
+    test_dp_params['batch_cache'] = args.cache_test_batches
+    test_dp_params['batch_cache_dir'] = args.test_batch_cache_dir
+  param_dict['dp_params'] = dp_params
+  param_dict['test_dp_params'] = test_dp_params
+
   dp_class = DataProvider.get_by_name(param_dict['data_provider'])
-  train_dp = dp_class(param_dict['data_dir'], param_dict['train_range'])
-  test_dp = dp_class(param_dict['data_dir'], param_dict['test_range'])
+  train_dp = dp_class(param_dict['data_dir'], param_dict['train_range'], **dp_params)
+  test_dp = dp_class(param_dict['test_data_dir'], param_dict['test_range'], **test_dp_params)
   param_dict['train_dp'] = train_dp
   param_dict['test_dp'] = test_dp
 
@@ -782,5 +1064,8 @@ if __name__ == '__main__':
 
   trainer = Trainer.get_trainer_by_name(trainer, param_dict)
   util.log('start to train...')
-  trainer.train()
+  try:
+    trainer.train()
+  finally:
+    trainer.close()
   #trainer.predict(['pool5'], 'image.opt')
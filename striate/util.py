@@ -1,4 +1,7 @@
 import cPickle
+import collections
+import contextlib
+import importlib
 import os
 import sys
 import threading
@@ -46,6 +49,60 @@ class Timer:
 
 timer = Timer()
 
+
+class StageTimer(object):
+  '''
+  Accumulates the time spent in named stages.  Safe to share between threads,
+  e.g. the reader threads of a data provider:
+
+    with provider.timings('decode'):
+      ...
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.seconds = collections.defaultdict(float)
+      self.counts = collections.defaultdict(int)
+
+  def add(self, stage, seconds):
+    with self._lock:
+      self.seconds[stage] += seconds
+      self.counts[stage] += 1
+
+  @contextlib.contextmanager
+  def __call__(self, stage):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.add(stage, time.time() - start)
+
+  def report(self):
+    with self._lock:
+      return dict((stage, {'seconds': self.seconds[stage], 'count': self.counts[stage]})
+                  for stage in self.seconds)
+
+class LazyModule(object):
+  '''
+  Stands for the module `name` and imports it, after the modules in
+  `requires`, on first attribute access.  For modules that are expensive or
+  have side effects on import, such as pycuda creating a CUDA context.
+  '''
+  def __init__(self, name, *requires):
+    self._name = name
+    self._requires = requires
+    self._module = None
+
+  def __getattr__(self, attr):
+    if self._module is None:
+      for name in self._requires:
+        importlib.import_module(name)
+      self._module = importlib.import_module(self._name)
+    return getattr(self._module, attr)
+
 def divup(x, base):
   if x / base * base == x:
     return x / base
@@ -0,0 +1,25 @@
+from striate import augment
+import numpy as np
+
+def crop_one(img, start_y, start_x, size, flip):
+  pic = img[:, start_y:start_y + size, start_x:start_x + size]
+  if flip:
+    pic = pic[:, :, ::-1]
+  return pic.reshape((pic.size,))
+
+def test_batch_crop_flip():
+  num, img_size, size = 8, 64, 48
+  images = np.random.randint(0, 256, size = (num, 3, img_size, img_size)).astype(np.uint8)
+  start_y = np.random.randint(0, img_size - size + 1, size = num)
+  start_x = np.random.randint(0, img_size - size + 1, size = num)
+  flip = np.random.randint(2, size = num) == 0
+
+  target = np.zeros((3 * size * size, num + 2), dtype = np.uint8)
+  augment.batch_crop_flip(images, start_y, start_x, size, flip, target)
+
+  for i in range(num):
+    assert (target[:, i] == crop_one(images[i], start_y[i], start_x[i], size, flip[i])).all()
+  assert (target[:, num:] == 0).all()
+
+if __name__ == '__main__':
+  test_batch_crop_flip()
@@ -1,4 +1,8 @@
 from striate import data, util
+import cPickle
+import numpy as np
+import random
+import time
 
 def test_imagenet_loader():
   df = data.ImageNetDataProvider('/ssd/nn-data/imagenet/', 
@@ -11,5 +15,140 @@ def test_imagenet_loader():
   util.log('%s', df._get_next_batch()['data'].shape)
   util.log('Index: %s', df.curr_batch_index) 
 
+class CountingDataProvider(data.ParallelDataProvider):
+  '''
+  Batch i is a (4, 8) pool buffer of i + 1 with labels i, or raises for the
+  batches in `fail`.  Loading takes up to `delay` seconds, so that readers
+  finish out of order.  `advanced` is the order the batches were scheduled in,
+  `epochs` their epochs.
+  '''
+  def __init__(self, num_batches = 6, fail = (), delay = 0, **kw):
+    self.num_batches = num_batches
+    self.fail = fail
+    self.delay = delay
+    self.advanced = []
+    self.epochs = []
+    data.ParallelDataProvider.__init__(self, '.', None, **kw)
+
+  def get_batch_indexes(self):
+    return range(self.num_batches)
+
+  def _advance(self):
+    batch, epoch = data.ParallelDataProvider._advance(self)
+    self.advanced.append(batch)
+    self.epochs.append(epoch)
+    return batch, epoch
+
+  def _load_batch(self, batch):
+    if self.delay:
+      time.sleep(random.random() * self.delay)
+    if batch in self.fail:
+      raise IOError('Cannot load batch %d' % batch)
+    buf = self.buffers.get((4, 8), np.float32)
+    buf[...] = batch + 1
+    return buf, np.ones(8, dtype = np.float32) * batch
+
+def test_prefetcher_delivers_in_order():
+  dp = CountingDataProvider(num_batches = 5, delay = 0.005, prefetch = 4, num_readers = 4)
+  batches = list(dp.iter_batches(20))
+  dp.close()
+  assert [int(b.labels[0]) for b in batches] == dp.advanced[:20]
+  assert all((b.data == b.labels[0] + 1).all() for b in batches)
+  # every full epoch holds every batch once
+  for epoch in sorted(set(b.epoch for b in batches))[1:-1]:
+    assert sorted(int(b.labels[0]) for b in batches if b.epoch == epoch) == range(5)
+
+def test_prefetcher_raises_reader_errors_in_order():
+  dp = CountingDataProvider(num_batches = 5, fail = (3,), delay = 0.005, prefetch = 4, num_readers = 4)
+  seen = []
+  try:
+    for b in dp.iter_batches(10):
+      seen.append(int(b.labels[0]))
+    assert False, 'The failed batch was not reported'
+  except IOError:
+    pass
+  # the batches before the failed one came through, in order
+  assert seen == dp.advanced[:dp.advanced.index(3)]
+  # and reading goes on after it
+  assert int(dp.iter_batches(1).next().labels[0]) == dp.advanced[len(seen) + 1]
+  dp.close()
+
+def test_reset_mid_epoch_drops_loaded_batches():
+  dp = CountingDataProvider(num_batches = 5, delay = 0.005, prefetch = 4, num_readers = 2)
+  list(dp.iter_batches(2))
+  dp.reset()
+  mark = len(dp.advanced)
+  batches = list(dp.iter_batches(6))
+  dp.close()
+  assert batches[0].epoch == 1
+  assert [int(b.labels[0]) for b in batches] == dp.advanced[mark:mark + 6]
+
+def test_buffer_pool_does_not_grow_across_resets():
+  for kw in [{}, {'shuffle_window': 3}, {'on_host': True}]:
+    dp = CountingDataProvider(prefetch = 4, num_readers = 2, **kw)
+    sizes = []
+    for i in range(10):
+      batch = dp.iter_batches(1).next()
+      dp.buffers.put(batch.data)
+      dp.reset()
+      sizes.append(len(dp.buffers))
+    dp.close()
+    # the loaded batches, the window and the batch being mixed
+    assert max(sizes) <= 4 + 2 + 2, (kw, sizes)
+
+def test_shuffle_window_mixes_batches_of_one_epoch():
+  dp = CountingDataProvider(num_batches = 5, shuffle_window = 3, prefetch = 2, num_readers = 2)
+  batches = list(dp.iter_batches(12))
+  dp.close()
+  scheduled = zip(dp.advanced, dp.epochs)[:12]
+  for b in batches:
+    assert (b.data == b.labels + 1).all()
+    # never samples of another epoch
+    assert set(b.labels) <= set(batch for batch, epoch in scheduled if epoch == b.epoch)
+  # every sample of the batches read comes out once
+  labels = np.concatenate([b.labels for b in batches])
+  assert sorted(labels) == sorted(np.repeat([batch for batch, _ in scheduled], 8))
+  assert any(len(set(b.labels)) > 1 for b in batches)
+
+def test_multiview_refuses_shuffle_window():
+  try:
+    data.ImageNetDataProvider('.', [0], multiview = True, test = True, shuffle_window = 2)
+    assert False, 'Multiview batches were shuffled across a window'
+  except AssertionError, e:
+    assert 'shuffle window' in str(e)
+
+def test_state_round_trip():
+  for kw in [{}, {'shuffle_window': 2}, {'fixed_batch_size': True}]:
+    make = lambda: data.SyntheticDataProvider(batch_range = range(5), image_shape = (1, 2, 2), batch_size = 8,
+                                              on_host = True, **kw)
+    dp = make()
+    for i in range(7):
+      dp.get_next_batch(3)
+    # as a checkpoint would
+    state = cPickle.loads(cPickle.dumps(dp.get_state(), -1))
+    # minibatches view the host batch, which is recycled
+    expected = [data.BatchData(b.data.copy(), b.labels.copy(), b.epoch)
+                for b in (dp.get_next_batch(3) for i in range(10))]
+    dp.close()
+
+    resumed = make()
+    resumed.set_state(state)
+    for want in expected:
+      got = resumed.get_next_batch(3)
+      assert np.array_equal(got.data, want.data) and np.array_equal(got.labels, want.labels), kw
+      assert got.epoch == want.epoch
+    resumed.close()
+
+def test_set_state_refuses_other_positions():
+  dp = data.SyntheticDataProvider(batch_range = range(5), on_host = True)
+  other = data.SyntheticDataProvider(batch_range = range(6), on_host = True)
+  state = dp.get_state()
+  for bad in [other.get_state(), dict((k, v) for k, v in state.iteritems() if k != 'epoch'), None]:
+    try:
+      dp.set_state(bad)
+      assert False, 'set_state took %s' % bad
+    except ValueError:
+      pass
+
 if __name__ == '__main__':
   test_imagenet_loader()
@@ -0,0 +1,44 @@
+from striate import data, dataservice
+import numpy as np
+import os
+import shutil
+import tempfile
+import threading
+
+def test_ring_serves_every_batch_to_two_consumers():
+  ring_dir = os.path.join(tempfile.mkdtemp(), 'ring')
+  # the latency keeps the service from running far ahead before the consumers attach
+  dp = data.SyntheticDataProvider(batch_range = range(4), image_shape = (3, 4, 4), batch_size = 8, latency = 0.01)
+  service = dataservice.DataService(dp, ring_dir, num_slots = 3, max_consumers = 2)
+  num_batches = 24
+  server = threading.Thread(target = service.run, args = (num_batches,))
+  server.start()
+  try:
+    consumers = [dataservice.RingConsumer(ring_dir, timeout = 10) for i in range(2)]
+    received = [{}, {}]
+    while any(c.next_seq < num_batches for c in consumers):
+      # alternate, so the service has to wait for the slower consumer
+      for c, batches in zip(consumers, received):
+        if c.next_seq >= num_batches:
+          continue
+        seq, slot, num, epoch = c.wait()
+        batch = np.empty((c.dims, num), dtype = np.float32), np.empty(num, dtype = np.float32)
+        assert c.read(seq, slot, num, *batch)
+        batches[seq] = batch
+
+    synthetic = dp.synthetic_batches.values()
+    for batches in received:
+      seqs = sorted(batches)
+      # nothing was overwritten before it was read
+      assert seqs == range(seqs[0], num_batches) and len(seqs) > service.num_slots
+      for seq in seqs:
+        batch, labels = batches[seq]
+        assert any(np.array_equal(batch, d) and np.array_equal(labels, l) for d, l in synthetic)
+    for seq in set(received[0]) & set(received[1]):
+      assert np.array_equal(received[0][seq][0], received[1][seq][0])
+    for c in consumers:
+      c.close()
+  finally:
+    server.join()
+    service.close()
+    shutil.rmtree(os.path.dirname(ring_dir))
@@ -0,0 +1,70 @@
+from PIL import Image
+from striate import decoder
+import numpy as np
+import os
+import shutil
+import tempfile
+
+def make_jpegs(dirname, num, size = 256):
+  names = []
+  for i in range(num):
+    pixels = np.random.randint(0, 256, size = (size, size, 3)).astype(np.uint8)
+    filename = os.path.join(dirname, 'n0000_%d.jpg' % i)
+    Image.fromarray(pixels).save(filename)
+    names.append(filename)
+  return names
+
+def test_decode_pool_matches_serial():
+  dirname = tempfile.mkdtemp()
+  try:
+    num = 16
+    names = make_jpegs(dirname, num)
+    serial = np.array([decoder.load_image(f) for f in names])
+
+    pool = decoder.DecodePool(4, (num, 3, 256, 256))
+    slot = pool.decode(names)
+    assert (pool.slots[slot] == serial).all()
+    pool.release(slot)
+    pool.close()
+  finally:
+    shutil.rmtree(dirname)
+
+def test_image_cache_evicts_least_recently_used():
+  shape = (3, 4, 4)
+  cache = decoder.ImageCache(2 * 3 * 4 * 4, shape)
+  images = np.random.randint(0, 256, size = (3,) + shape).astype(np.uint8)
+  cache.insert([10, 11], images[:2])
+
+  out = np.zeros((2,) + shape, dtype=np.uint8)
+  assert list(cache.lookup([11, 12], out)) == [1]
+  assert (out[0] == images[1]).all()
+
+  # 10 is now the least recently used entry
+  cache.insert([12], images[2:])
+  assert list(cache.lookup([10, 11, 12], np.zeros((3,) + shape, dtype=np.uint8))) == [0]
+  assert cache.hits == 3 and cache.misses == 2
+
+def test_load_image_resizes_large_jpegs():
+  dirname = tempfile.mkdtemp()
+  try:
+    pixels = np.random.randint(0, 256, size = (375, 500, 3)).astype(np.uint8)
+    filename = os.path.join(dirname, 'n0000_0.jpg')
+    Image.fromarray(pixels).save(filename)
+
+    img = decoder.load_image(filename, 256, cache_dir = dirname)
+    assert img.shape == (3, 256, 256)
+    assert os.path.exists(decoder.resize_cache_path(dirname, filename, 256))
+    assert (decoder.load_image(filename, 256, cache_dir = dirname) == img).all()
+
+    # images of the right size are decoded as they are, and not cached
+    os.mkdir(os.path.join(dirname, 'native'))
+    native = make_jpegs(os.path.join(dirname, 'native'), 1)[0]
+    assert (decoder.load_image(native, 256, cache_dir = dirname) == decoder.load_image(native)).all()
+    assert not os.path.exists(decoder.resize_cache_path(dirname, native, 256))
+  finally:
+    shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+  test_decode_pool_matches_serial()
+  test_image_cache_evicts_least_recently_used()
+  test_load_image_resizes_large_jpegs()
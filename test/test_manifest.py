@@ -0,0 +1,52 @@
+from PIL import Image
+from striate import decoder
+from striate.manifest import ImageManifest, CategoryIndex, TarManifest, load_manifest
+import numpy as np
+import os
+import shutil
+import tarfile
+import tempfile
+
+def make_manifest(labels, cat_index):
+  num = len(labels)
+  paths = np.array(['n%d/%d.jpg' % (l, i) for l, i in zip(labels, cat_index)])
+  return ImageManifest('.', paths, np.array(labels, dtype=np.int32), np.array(cat_index, dtype=np.int32),
+                       np.zeros(num, dtype=np.int64), None, None, None)
+
+def test_category_index_matches_mask_selection():
+  rng = np.random.RandomState(0)
+  labels = rng.randint(-1, 10, size = 500)
+  cat_index = rng.randint(0, 50, size = 500)
+  index = CategoryIndex(make_manifest(labels, cat_index))
+
+  for cat_range, category_range in [(range(0, 40), None), (range(40, 50), range(3)), (range(50), [7, 2, 11])]:
+    mask = np.in1d(cat_index, cat_range) & (labels >= 0)
+    if category_range is not None:
+      mask &= np.in1d(labels, category_range)
+    assert np.array_equal(index.select(cat_range, category_range), np.flatnonzero(mask))
+
+def test_tar_manifest_reads_members():
+  dirname = tempfile.mkdtemp()
+  try:
+    images = {}
+    for synid in ['001', '002']:
+      archive = tarfile.open(os.path.join(dirname, 'n%s.tar' % synid), 'w')
+      for i in range(3):
+        filename = os.path.join(dirname, 'n%s_%d.JPEG' % (synid, i))
+        Image.fromarray(np.random.randint(0, 256, size = (32, 48, 3)).astype(np.uint8)).save(filename)
+        images[filename] = decoder.load_image(filename, 32)
+        archive.add(filename, os.path.basename(filename))
+      archive.close()
+
+    manifest = load_manifest(dirname, {'001': 0, '002': 1}, manifest_class = TarManifest)
+    assert list(manifest.labels) == [0, 0, 0, 1, 1, 1]
+    assert list(manifest.cat_index) == [0, 1, 2, 0, 1, 2]
+    for name, source in zip(manifest.paths, manifest.sources()):
+      assert (decoder.load_image(source, 32) == images[os.path.join(dirname, name)]).all()
+    assert load_manifest(dirname, {'001': 0, '002': 1}, manifest_class = TarManifest).is_valid({'001': 0, '002': 1})
+  finally:
+    shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+  test_category_index_matches_mask_selection()
+  test_tar_manifest_reads_members()
@@ -0,0 +1,93 @@
+from striate import trainer
+from striate.data import shard_filename
+import numpy as np
+import os
+import shutil
+import tempfile
+
+def make_batches(num, size = 5, dims = 6):
+  return [{'labels' : np.arange(i * size, (i + 1) * size, dtype = np.float32),
+           'fc' : np.random.randn(size, dims).astype(np.float32)} for i in range(num)]
+
+def test_npy_appender_writes_column_major_npy():
+  dirname = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(dirname, 'fc.npy')
+    rows = np.random.randn(7, 2, 3).astype(np.float32)
+    f = trainer.NpyAppender(filename, 6, np.float32)
+    f.append(rows[:3])
+    f.append(rows[3:])
+    assert not os.path.exists(filename)
+    f.close()
+    data = np.load(filename)
+    assert data.shape == (6, 7) and np.isfortran(data)
+    assert (data == rows.reshape((7, 6)).T).all()
+  finally:
+    shutil.rmtree(dirname)
+
+def test_data_dumper_close_writes_every_batch():
+  dirname = tempfile.mkdtemp()
+  try:
+    target = os.path.join(dirname, 'train-data.pickle')
+    # 2 batches of 5 * 7 elements fill a shard
+    dumper = trainer.DataDumper(target, max_mem_size = 60, max_queue = 2)
+    batches = make_batches(5)
+    for b in batches:
+      dumper.add(b)
+    dumper.close()
+    assert not dumper._writer and dumper.get_count() == 3
+
+    for k in ['labels', 'fc']:
+      shards = [np.load(shard_filename(target, i, k)) for i in range(dumper.get_count())]
+      assert [s.shape[1] for s in shards] == [10, 10, 5]
+      expected = np.concatenate([b[k].reshape((5, -1)) for b in batches]).T
+      assert (np.concatenate(shards, axis = 1) == expected).all()
+
+    # closing twice is harmless; adding afterwards is not
+    dumper.close()
+    try:
+      dumper.add(batches[0])
+      assert False
+    except ValueError:
+      pass
+  finally:
+    shutil.rmtree(dirname)
+
+def test_data_dumper_raises_writer_errors():
+  dirname = tempfile.mkdtemp()
+  try:
+    dumper = trainer.DataDumper(os.path.join(dirname, 'missing', 'train-data.pickle'))
+    dumper.add(make_batches(1)[0])
+    try:
+      dumper.close()
+      assert False
+    except IOError:
+      pass
+    assert not dumper._writer
+  finally:
+    shutil.rmtree(dirname)
+
+def test_memory_data_holder_spills_least_recently_used_chunks():
+  # each batch is 140 bytes and fills a chunk; three fit in memory
+  holder = trainer.MemoryDataHolder(single_memory_size = 100, total_memory_size = 450)
+  batches = make_batches(5)
+  for b in batches[:3]:
+    holder.add(b)
+  assert holder.get_count() == 3 and not holder.spilled_chunk
+
+  holder.get_chunk(0)
+  for b in batches[3:]:
+    holder.add(b)
+  assert sorted(holder.memory_chunk) == [0, 3, 4] and sorted(holder.spilled_chunk) == [1, 2]
+  spill_dir = holder.spill_dir
+  assert os.path.isdir(spill_dir)
+
+  for i, b in enumerate(batches):
+    chunk = holder.get_chunk(i)
+    for k in b:
+      assert (chunk[k] == b[k]).all()
+  # reading a spilled chunk does not bring it back into memory
+  assert sorted(holder.spilled_chunk) == [1, 2]
+
+  holder.close()
+  assert not os.path.exists(spill_dir)